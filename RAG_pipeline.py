@@ -1,47 +1,279 @@
-﻿from config import api_key
-from utils import *
+﻿from utils import (
+    load_or_build_store, load_or_create_vectorstore, setup_retrievers, corpus_fingerprint, index_params,
+    configure_search, index_memory_bytes, estimate_tokens, pack_context, BackgroundEmbeddings, TokenBucket,
+    PackedContextRetriever
+)
+from cache import AnswerCache, ParaphraseCache, CachedEmbeddings
+from llm_clients import get_llm
+from metrics import span, record
 
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain.chains import RetrievalQA
+from langchain_core.prompts import format_document
+import threading
 import time
+import os
 
 
-def RAG_pipeline():
+def load_embeddings(model_name):
     """
-    Создает и настраивает полный RAG пайплайн.
-    
+    Создает модель эмбеддингов HuggingFace. Модуль langchain_huggingface
+    (вместе с sentence-transformers и torch) импортируется только здесь.
+
+    Args:
+        model_name (str): Название модели эмбеддингов
+
     Returns:
-        RetrievalQA: Настроенная цепочка для вопросно-ответной системы
+        HuggingFaceEmbeddings: Модель эмбеддингов
     """
-    print("Начало работы.\nСоздание RAG-системы запущено.")
-    start_time = time.time()
-    
-    # Загрузка и подготовка данных
-    texts = load_and_split_text()
-    
-    # Инициализация эмбеддингов
-    embeddings = HuggingFaceEmbeddings(
-        model_name="sergeyzh/LaBSE-ru-sts",
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    return HuggingFaceEmbeddings(
+        model_name=model_name,
         model_kwargs={'device': 'cpu'},
         encode_kwargs={'normalize_embeddings': True}
     )
+
+
+class RAGEngine:
+    """
+    Общий для всего процесса RAG-движок.
+
+    Хранит модель эмбеддингов, векторное хранилище, TF-IDF индекс, клиент LLM
+    и собранную RAG-цепочку. Создается один раз и разделяется между всеми
+    сессиями (CLI, телеграм-бот), поэтому не должен хранить состояние пользователей.
+    """
+
+    def __init__(self, data_path="data/all_content.txt", index_path="faiss_index",
+                 embedding_model="sergeyzh/LaBSE-ru-sts", chunk_size=500, chunk_overlap=50,
+                 index_config=None, nprobe=8, ef_search=64,
+                 llm_model="mistral-large-latest", llm_backend=None, context_token_budget=1200,
+                 requests_per_second=1.0, burst=6,
+                 cache_path=None, cache_size=1024, cache_ttl=3600, semantic_threshold=0.95,
+                 embeddings=None, background_warmup=True, embedding_cache=True, query_cache_size=4096):
+        """
+        Args:
+            data_path (str): Путь к текстовому файлу базы знаний
+            index_path (str): Путь к папке векторного индекса
+            embedding_model (str): Название модели эмбеддингов
+            chunk_size (int): Размер чанка текста
+            chunk_overlap (int): Размер перекрытия между чанками
+            index_config (dict): Тип и параметры индекса FAISS (см. utils.DEFAULT_INDEX_CONFIG)
+            nprobe (int): Число просматриваемых кластеров при поиске по IVF индексу
+            ef_search (int): Размер списка кандидатов при поиске по HNSW индексу
+            llm_model (str): Название языковой модели
+            llm_backend (str): mistral или fake (см. llm_clients.get_llm)
+            context_token_budget (int): Максимальное число токенов контекста в промпте (None -- без ограничения)
+            requests_per_second (float): Допустимая частота обращений к API LLM
+            burst (int): Сколько обращений к API можно отправить одновременно без ожидания
+            cache_path (str): Файл SQLite для кэшей ответов и перефразировок (None -- кэши только в памяти)
+            cache_size (int): Максимальное число ответов в кэше
+            cache_ttl (float): Время жизни ответа в кэше в секундах
+            semantic_threshold (float): Порог близости вопросов для семантического попадания в кэш
+            embeddings: Готовая модель эмбеддингов вместо embedding_model
+                (например, детерминированная заглушка для бенчмарков)
+            background_warmup (bool): Загружать модель эмбеддингов в фоне: движок готов
+                принимать вопросы сразу после загрузки индексов, а первый поиск
+                дожидается окончания загрузки модели
+            embedding_cache (bool): Сохранять эмбеддинги чанков и запросов в <index_path>/embeddings.db
+                (False -- кэшируются только запросы и только в памяти)
+            query_cache_size (int): Максимальное число эмбеддингов запросов в кэше
+                (0 -- каждый запрос кодируется моделью заново)
+        """
+        print("Начало работы.\nСоздание RAG-системы запущено.")
+        start_time = time.time()
+
+        # Инициализация эмбеддингов (в фоне, пока загружаются чанки и индексы)
+        if embeddings is None and background_warmup:
+            embeddings = BackgroundEmbeddings(lambda: load_embeddings(embedding_model))
+        elif embeddings is None:
+            with span("init.embedding_model", model=embedding_model):
+                embeddings = load_embeddings(embedding_model)
+
+        # Кэш эмбеддингов по хешу текста: модель вызывается только для новых чанков и запросов
+        os.makedirs(index_path, exist_ok=True)
+        self.embeddings = CachedEmbeddings(
+            embeddings, embedding_model,
+            db_path=os.path.join(index_path, "embeddings.db") if embedding_cache else None,
+            max_queries=query_cache_size
+        )
+
+        # Открытие хранилища чанков (корпус разбивается заново только при его изменении)
+        with span("init.split"):
+            self.store = load_or_build_store(
+                data_path, chunk_size, chunk_overlap,
+                store_path=os.path.join(index_path, "chunks")
+            )
+        record("init.chunks", len(self.store))
+
+        # Создание или загрузка векторного хранилища
+        with span("init.index"):
+            self.vectorstore = load_or_create_vectorstore(
+                self.store, self.embeddings,
+                index_path=index_path,
+                model_name=embedding_model,
+                chunk_size=chunk_size,
+                chunk_overlap=chunk_overlap,
+                index_config=index_config,
+                new=False
+            )
+        self.set_search_params(nprobe, ef_search)
+
+        # Отпечаток корпуса, к которому привязаны все сохраненные индексы
+        self.fingerprint = corpus_fingerprint(self.store.chunk_ids, index_params(embedding_model, chunk_size, chunk_overlap))
+
+        # Настройка retrievers
+        with span("init.tfidf"):
+            self.retriever = setup_retrievers(self.vectorstore, self.store, index_path, self.fingerprint)
+
+        # Кэш ответов на повторные и близкие по смыслу вопросы
+        self.answer_cache = AnswerCache(
+            embed_fn=self.embeddings.embed_query,
+            fingerprint=self.fingerprint,
+            max_size=cache_size,
+            ttl=cache_ttl,
+            similarity_threshold=semantic_threshold,
+            db_path=cache_path
+        )
+
+        # Кэш перефразировок вопросов
+        self.paraphrase_cache = ParaphraseCache(db_path=cache_path)
+
+        # Инициализация языковой модели
+        self.llm = get_llm(llm_model, llm_backend)
+        self.context_token_budget = context_token_budget
+
+        # Общий для всех сессий ограничитель частоты обращений к API
+        self.rate_limiter = TokenBucket(rate=requests_per_second, capacity=burst)
+
+        # Создание RAG цепочки (контекст упаковывается так же, как в generate)
+        from langchain.chains import RetrievalQA
+
+        self.qa_chain = RetrievalQA.from_chain_type(
+            llm=self.llm,
+            chain_type="stuff",
+            retriever=PackedContextRetriever(retriever=self.retriever, pack=self.build_context),
+            return_source_documents=True
+        )
+
+        record("init.total", time.time() - start_time, unit="s")
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        """
+        Меняет параметры точности/скорости поиска по индексу FAISS.
+
+        Args:
+            nprobe (int): Число просматриваемых кластеров IVF
+            ef_search (int): Размер списка кандидатов HNSW
+        """
+        configure_search(self.vectorstore.index, nprobe, ef_search)
+
+    def index_memory_bytes(self):
+        """
+        Returns:
+            int: Объем памяти, занимаемой индексом FAISS, в байтах
+        """
+        return index_memory_bytes(self.vectorstore.index)
+
+    def retrieve_batch(self, queries, metadata_filter=None):
+        """
+        Находит документы сразу для списка запросов одним батчевым проходом retriever-а.
+
+        Args:
+            queries (list): Список запросов
+            metadata_filter (dict): Искать только в документах с такими метаданными,
+                например {'season': 3} или {'hero': 'Джон Сноу'}
+
+        Returns:
+            list: Списки найденных документов в порядке запросов
+        """
+        with span("retrieve", queries=len(queries), filtered=bool(metadata_filter)):
+            retrieved = self.retriever.retrieve_batch(queries, metadata_filter)
+        for docs in retrieved:
+            record("retrieve.chunks", len(docs))
+        return retrieved
+
+    def build_context(self, docs):
+        """
+        Упаковывает найденные документы в контекст промпта: без почти дубликатов,
+        со склеенными соседними чанками и в пределах бюджета токенов.
+
+        Args:
+            docs (list): Документы, отсортированные по убыванию релевантности
+
+        Returns:
+            tuple: (документы контекста, оценка числа токенов контекста)
+        """
+        return pack_context(docs, self.context_token_budget)
+
+    def generate(self, question, docs, on_token=None):
+        """
+        Генерирует ответ на вопрос по уже найденным документам (шаг "stuff" RAG цепочки).
+
+        Args:
+            question (str): Вопрос пользователя
+            docs (list): Найденные документы, отсортированные по убыванию релевантности
+            on_token: Функция, получающая фрагменты ответа по мере их генерации
+                (None -- ответ запрашивается целиком, без потоковой выдачи)
+
+        Returns:
+            tuple: (ответ модели, оценка числа токенов вопроса и контекста в промпте)
+        """
+        context, context_tokens = self.build_context(docs)
+        prompt_tokens = estimate_tokens(question) + context_tokens
+        chain = self.qa_chain.combine_documents_chain
+        record("generate.prompt_tokens", prompt_tokens)
+        record("generate.context_chunks", len(context))
+
+        if on_token is None:
+            with span("generate"):
+                result = chain.invoke({"input_documents": context, "question": question})
+            return result["output_text"], prompt_tokens
+
+        # тот же промпт, что собирает stuff-цепочка, но ответ модели читается потоком
+        prompt = chain.llm_chain.prompt.format_prompt(**{
+            chain.document_variable_name: chain.document_separator.join(
+                format_document(doc, chain.document_prompt) for doc in context
+            ),
+            "question": question,
+        })
+        parts = []
+        start = time.perf_counter()
+        with span("generate", streaming=True):
+            for chunk in self.llm.stream(prompt):
+                if chunk.content:
+                    if not parts:
+                        record("generate.first_token", time.perf_counter() - start, unit="s")
+                    parts.append(chunk.content)
+                    on_token(chunk.content)
+        return "".join(parts), prompt_tokens
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_rag_engine():
+    """
+    Возвращает общий RAG-движок, создавая его при первом обращении.
+    Потокобезопасно: при одновременных вызовах движок строится ровно один раз.
+
+    Returns:
+        RAGEngine: Общий для процесса RAG-движок
+    """
+    global _engine
+
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = RAGEngine()
+
+    return _engine
+
+
+def RAG_pipeline():
+    """
+    Возвращает RAG цепочку общего движка (создает движок при первом вызове).
     
-    # Создание или загрузка векторного хранилища
-    vectorstore = load_or_create_vectorstore(texts, embeddings, new=False)
-    
-    # Настройка retrievers
-    ensemble_retriever = setup_retrievers(vectorstore, texts)
-    
-    # Инициализация языковой модели
-    llm = initialize_llm(api_key)
-    
-    end_time = time.time()
-    # print(f"Время создания RAG: {round(end_time - start_time, 3)}")
-
-    # Создание RAG цепочки
-    return RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        retriever=ensemble_retriever,
-        return_source_documents=True
-    )
\ No newline at end of file
+    Returns:
+        RetrievalQA: Настроенная цепочка для вопросно-ответной системы
+    """
+    return get_rag_engine().qa_chain
@@ -0,0 +1,202 @@
+"""
+Оценка качества и скорости поиска на размеченном наборе вопросов.
+
+Каждый вопрос из questions.json размечен фразами, которые должны встретиться
+в релевантном чанке. Разметка не привязана к номерам чанков, поэтому
+одинаково работает при любом chunk_size. Для каждой конфигурации
+(chunk_size, тип индекса, k, веса FAISS/TF-IDF) считаются recall@k, MRR@k,
+задержка поиска и объем памяти индексов и хранилища чанков. В конце выводится
+таблица, в которой отмечены Парето-оптимальные конфигурации по качеству и задержке.
+
+Пример запуска:
+    python benchmarks/eval_retrieval.py --chunk-sizes 300 500 --index-types flat hnsw --ks 3 5
+    python benchmarks/eval_retrieval.py --fake-embeddings   # быстрый прогон без модели эмбеддингов
+"""
+
+from run_benchmarks import ROOT, DATA_PATH, EMBEDDING_SIZE, latency_stats, git_commit
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from RAG_pipeline import RAGEngine, load_embeddings
+from utils import DEFAULT_INDEX_CONFIG
+
+from itertools import product
+import argparse
+import json
+import time
+import os
+
+
+QUESTIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "questions.json")
+
+
+def normalize(text):
+    return text.lower().replace('ё', 'е')
+
+
+def load_questions(path=QUESTIONS_PATH):
+    """
+    Returns:
+        list: Пары (вопрос, нормализованные фразы, по которым узнается релевантный чанк)
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        return [(item['question'], [normalize(p) for p in item['expected']]) for item in json.load(f)]
+
+
+def first_relevant_rank(docs, expected):
+    """
+    Returns:
+        int: Позиция (с единицы) первого чанка, содержащего одну из ожидаемых фраз, или None
+    """
+    for rank, doc in enumerate(docs, 1):
+        content = normalize(doc.page_content)
+        if any(phrase in content for phrase in expected):
+            return rank
+    return None
+
+
+def tfidf_memory_bytes(retriever):
+    matrix = retriever.tfidf_matrix
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+def evaluate(engine, questions, k, weights):
+    """
+    Оценивает качество и задержку поиска одной конфигурации retriever-а.
+
+    Returns:
+        dict: recall@k, MRR@k и перцентили задержки
+    """
+    engine.retriever.k = k
+    engine.retriever.weights = list(weights)
+    engine.retrieve_batch([questions[0][0]])
+
+    hits, reciprocal_ranks, samples = 0, 0.0, []
+    for question, expected in questions:
+        start = time.perf_counter()
+        docs = engine.retrieve_batch([question])[0][:k]
+        samples.append(time.perf_counter() - start)
+
+        rank = first_relevant_rank(docs, expected)
+        if rank is not None:
+            hits += 1
+            reciprocal_ranks += 1 / rank
+
+    return {
+        'recall': hits / len(questions),
+        'mrr': reciprocal_ranks / len(questions),
+        'latency': latency_stats(samples),
+    }
+
+
+def pareto_front(rows):
+    """
+    Отмечает конфигурации, для которых нет другой не хуже по recall, MRR и задержке
+    и строго лучше хотя бы по одному из этих показателей.
+    """
+    def key(row):
+        return row['recall'], row['mrr'], -row['latency']['p50_ms']
+
+    for row in rows:
+        a = key(row)
+        row['pareto'] = not any(
+            all(x >= y for x, y in zip(key(other), a)) and key(other) != a
+            for other in rows
+        )
+
+
+def print_table(rows):
+    print(f"\n{'chunk':>6} {'индекс':>9} {'k':>3} {'веса':>10} {'recall':>7} {'MRR':>6} "
+          f"{'p50, мс':>8} {'p95, мс':>8} {'память, МБ':>11}")
+    for row in sorted(rows, key=lambda r: r['latency']['p50_ms']):
+        weights = "/".join(f"{w:g}" for w in row['weights'])
+        print(f"{row['chunk_size']:>6} {row['index_type']:>9} {row['k']:>3} {weights:>10} "
+              f"{row['recall']:>7.2f} {row['mrr']:>6.2f} {row['latency']['p50_ms']:>8.2f} "
+              f"{row['latency']['p95_ms']:>8.2f} {row['memory_bytes'] / 2**20:>11.1f}"
+              f"{'  *' if row['pareto'] else ''}")
+    print("\n* -- Парето-оптимальные конфигурации по recall, MRR и задержке p50")
+
+
+def sweep(embeddings, embedding_model, chunk_sizes, index_types, ks, weight_options, work_dir):
+    """
+    Перебирает конфигурации; индексы строятся один раз на пару (chunk_size, тип индекса)
+    и сохраняются в work_dir для повторных запусков. Кэш эмбеддингов запросов отключен:
+    иначе все конфигурации, кроме первой, получали бы эмбеддинги вопросов без вызова модели.
+
+    Returns:
+        list: Результаты по каждой конфигурации
+    """
+    questions = load_questions()
+    rows = []
+
+    for chunk_size, index_type in product(chunk_sizes, index_types):
+        print(f"\n=== chunk_size={chunk_size}, индекс {index_type} ===")
+        engine = RAGEngine(
+            data_path=DATA_PATH,
+            index_path=os.path.join(work_dir, f"{embedding_model.replace('/', '_')}_{chunk_size}_{index_type}"),
+            embedding_model=embedding_model,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_size // 10,
+            index_config={**DEFAULT_INDEX_CONFIG, 'index_type': index_type},
+            llm_backend="fake",
+            embeddings=embeddings,
+            query_cache_size=0
+        )
+        memory = engine.index_memory_bytes() + tfidf_memory_bytes(engine.retriever) + engine.store.nbytes
+
+        for k, weights in product(ks, weight_options):
+            result = evaluate(engine, questions, k, weights)
+            rows.append({
+                'chunk_size': chunk_size,
+                'index_type': index_type,
+                'k': k,
+                'weights': list(weights),
+                'chunks': len(engine.store),
+                'memory_bytes': memory,
+                **result,
+            })
+
+    pareto_front(rows)
+    return rows
+
+
+def parse_weights(value):
+    weights = [float(w) for w in value.split(",")]
+    if len(weights) != 2:
+        raise argparse.ArgumentTypeError("веса задаются парой FAISS,TF-IDF, например 0.75,0.25")
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Оценка качества и скорости поиска")
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[300, 500, 800])
+    parser.add_argument("--index-types", nargs="+", default=["flat", "hnsw"],
+                        choices=["flat", "ivf_flat", "hnsw", "ivf_pq"])
+    parser.add_argument("--ks", type=int, nargs="+", default=[3, 5, 8])
+    parser.add_argument("--weights", type=parse_weights, nargs="+",
+                        default=[[0.75, 0.25], [0.5, 0.5], [1.0, 0.0]], help="Пары весов FAISS,TF-IDF")
+    parser.add_argument("--embedding-model", default="sergeyzh/LaBSE-ru-sts")
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="Детерминированная заглушка вместо модели эмбеддингов (проверка работы скрипта)")
+    parser.add_argument("--work-dir", default=os.path.join(ROOT, "eval_indexes"), help="Папка для индексов")
+    parser.add_argument("--output", default="eval_results.json", help="Файл для результатов")
+    args = parser.parse_args()
+
+    if args.fake_embeddings:
+        embedding_model = f"fake-{EMBEDDING_SIZE}"
+        embeddings = DeterministicFakeEmbedding(size=EMBEDDING_SIZE)
+    else:
+        embedding_model = args.embedding_model
+        embeddings = load_embeddings(embedding_model)
+
+    rows = sweep(embeddings, embedding_model, args.chunk_sizes, args.index_types, args.ks, args.weights, args.work_dir)
+    print_table(rows)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'commit': git_commit(), 'embedding_model': embedding_model, 'results': rows},
+                  f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""
+Офлайн-бенчмарки горячих путей RAG системы.
+
+Работают без сети: вместо модели эмбеддингов используется детерминированная
+заглушка, вместо Mistral -- локальная модель-заглушка (llm_backend="fake").
+Корпус -- data/all_content.txt, для оценки масштабирования он синтетически
+увеличивается в 10 и 100 раз. Результаты сохраняются в JSON, который можно
+сравнить с результатами другого коммита (параметр --compare).
+
+Пример запуска:
+    python benchmarks/run_benchmarks.py --scales 1 10 --output bench.json
+    python benchmarks/run_benchmarks.py --scales 1 10 --compare bench.json
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("RAG_LLM_BACKEND", "fake")
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from RAG_pipeline import RAGEngine
+from utils import load_or_build_store, build_faiss_index, HERO_HEADER_MAX_LENGTH
+from main import calculate_confidence, score_answers
+from llm_clients import FAKE_RESPONSES
+from metrics import percentile
+
+import subprocess
+import argparse
+import platform
+import tempfile
+import random
+import shutil
+import json
+import time
+
+
+DATA_PATH = os.path.join(ROOT, "data", "all_content.txt")
+
+# размер эмбеддинга заглушки совпадает с размером эмбеддинга LaBSE
+EMBEDDING_SIZE = 768
+
+QUERIES = [
+    "Кто настоящие родители Джона Сноу?",
+    "Как погиб Нед Старк?",
+    "Кто убил Короля Ночи?",
+    "Что случилось на Красной свадьбе?",
+    "Кто такая Арья Старк?",
+    "Как Дейенерис получила драконов?",
+    "Кто правил Семью Королевствами после смерти Роберта Баратеона?",
+    "Что такое валирийская сталь?",
+    "Кто такой Ходор и почему его так зовут?",
+    "Чем закончилась битва бастардов?",
+]
+
+
+def scaled_corpus(data_path, scale, out_dir):
+    """
+    Создает корпус, увеличенный в scale раз. В каждой копии к предложениям абзацев
+    дописывается номер копии (заголовки серий и имена персонажей остаются прежними), поэтому
+    чанки копий различаются по содержимому: их не объединяют ни разбиение по документам,
+    ни кэш эмбеддингов, и построение индекса действительно обрабатывает в scale раз больше текста.
+
+    Args:
+        data_path (str): Путь к исходному корпусу
+        scale (int): Во сколько раз увеличить корпус
+        out_dir (str): Папка для созданного файла
+
+    Returns:
+        str: Путь к увеличенному корпусу
+    """
+    if scale == 1:
+        return data_path
+
+    with open(data_path, 'r', encoding='utf-8') as f:
+        lines = f.read().split("\n")
+
+    path = os.path.join(out_dir, f"corpus_x{scale}.txt")
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(scale):
+            f.write(f"Копия корпуса {i}\n\n")
+            f.write("\n".join(
+                line.replace(". ", f" ({i}). ") + f" ({i})" if len(line) > HERO_HEADER_MAX_LENGTH else line
+                for line in lines
+            ))
+            f.write("\n\n")
+    return path
+
+
+def latency_stats(samples):
+    """
+    Args:
+        samples (list): Замеры времени в секундах
+
+    Returns:
+        dict: Перцентили и среднее в миллисекундах
+    """
+    values = sorted(samples)
+    return {
+        'n': len(values),
+        'mean_ms': 1000 * sum(values) / len(values),
+        'p50_ms': 1000 * percentile(values, 50),
+        'p95_ms': 1000 * percentile(values, 95),
+        'p99_ms': 1000 * percentile(values, 99),
+    }
+
+
+def bench_ingestion(data_path, embeddings, store_path):
+    """
+    Пропускная способность индексации: разбиение корпуса в хранилище чанков
+    и построение индекса FAISS.
+    """
+    start = time.perf_counter()
+    store = load_or_build_store(data_path, store_path=store_path)
+    split_seconds = time.perf_counter() - start
+
+    _, stats = build_faiss_index(store, embeddings)
+    total = split_seconds + stats['seconds']
+    return {
+        'chunks': stats['chunks'],
+        'split_seconds': split_seconds,
+        'index_seconds': stats['seconds'],
+        'chunks_per_sec': stats['chunks'] / total if total else 0.0,
+        'index_memory_bytes': stats['memory_bytes'],
+        'store_bytes': store.nbytes,
+    }
+
+
+def bench_cold_start(data_path, embeddings, index_path):
+    """
+    Время создания RAG-движка (время до готовности принимать вопросы):
+    с разбиением корпуса и построением индексов и с их загрузкой с диска.
+    Кэш эмбеддингов отключен, чтобы построение индекса вычисляло эмбеддинги всех чанков,
+    а замеры поиска (QUERIES повторяются repeats раз) включали кодирование каждого запроса.
+    """
+    def build():
+        start = time.perf_counter()
+        engine = RAGEngine(
+            data_path=data_path, index_path=index_path,
+            embedding_model=f"fake-{EMBEDDING_SIZE}", embeddings=embeddings, llm_backend="fake",
+            embedding_cache=False, query_cache_size=0
+        )
+        return engine, time.perf_counter() - start
+
+    _, build_seconds = build()
+    engine, load_seconds = build()
+    return engine, {'build_seconds': build_seconds, 'load_seconds': load_seconds}
+
+
+def bench_retrieval(engine, repeats):
+    """
+    Задержка поиска: одиночные запросы через интерфейс retriever-а
+    и пакеты из 6 перефразировок через retrieve_batch.
+    """
+    single = []
+    for _ in range(repeats):
+        for query in QUERIES:
+            start = time.perf_counter()
+            engine.retriever.invoke(query)
+            single.append(time.perf_counter() - start)
+
+    batch = []
+    for i in range(repeats * len(QUERIES) // 6):
+        queries = [QUERIES[(i + j) % len(QUERIES)] for j in range(6)]
+        start = time.perf_counter()
+        engine.retrieve_batch(queries)
+        batch.append(time.perf_counter() - start)
+
+    return {'single': latency_stats(single), 'batch_of_6': latency_stats(batch)}
+
+
+def bench_scoring(engine, repeats, seed=0):
+    """
+    Пропускная способность оценки ответов: по одному (calculate_confidence)
+    и пакетом из 6 ответов (score_answers).
+    """
+    rng = random.Random(seed)
+    retrieved = engine.retrieve_batch(QUERIES)
+    answers = FAKE_RESPONSES + [doc.page_content for docs in retrieved for doc in docs[:2]]
+    cases = [(rng.choice(answers), rng.choice(retrieved)) for _ in range(repeats)]
+
+    start = time.perf_counter()
+    for answer, sources in cases:
+        calculate_confidence(answer, sources)
+    single_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(0, len(cases), 6):
+        chunk = cases[i:i + 6]
+        score_answers([a for a, _ in chunk], [s for _, s in chunk])
+    batch_seconds = time.perf_counter() - start
+
+    return {
+        'answers': len(cases),
+        'single_per_sec': len(cases) / single_seconds,
+        'batch_per_sec': len(cases) / batch_seconds,
+    }
+
+
+def bench_import(repeats=3):
+    """
+    Время импорта модуля main в отдельном процессе (лучшее из нескольких запусков).
+    """
+    code = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+    samples = [
+        float(subprocess.check_output([sys.executable, "-c", code], cwd=ROOT, text=True).strip().splitlines()[-1])
+        for _ in range(repeats)
+    ]
+    return {'import_main_seconds': min(samples)}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scales, repeats, scoring_cases):
+    """
+    Запускает все бенчмарки для каждого масштаба корпуса.
+
+    Returns:
+        dict: Результаты и описание окружения
+    """
+    embeddings = DeterministicFakeEmbedding(size=EMBEDDING_SIZE)
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix="rag_bench_")
+
+    try:
+        for scale in scales:
+            print(f"\n=== Корпус x{scale} ===")
+            data_path = scaled_corpus(DATA_PATH, scale, work_dir)
+            index_path = os.path.join(work_dir, f"index_x{scale}")
+
+            ingestion = bench_ingestion(data_path, embeddings, os.path.join(work_dir, f"store_x{scale}"))
+            engine, cold_start = bench_cold_start(data_path, embeddings, index_path)
+            results[f"x{scale}"] = {
+                'corpus_bytes': os.path.getsize(data_path),
+                'ingestion': ingestion,
+                'cold_start': cold_start,
+                'retrieval': bench_retrieval(engine, repeats),
+                'scoring': bench_scoring(engine, scoring_cases),
+            }
+            print(json.dumps(results[f"x{scale}"], ensure_ascii=False, indent=2))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'config': {'scales': scales, 'repeats': repeats, 'scoring_cases': scoring_cases},
+        'results': {'startup': bench_import(), **results},
+    }
+
+
+def flatten(tree, prefix=""):
+    """
+    Переводит вложенный словарь результатов в плоский вида "x1.retrieval.single.p50_ms" -> значение.
+    """
+    flat = {}
+    for key, value in tree.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def compare(baseline, current):
+    """
+    Выводит отношение текущих результатов к результатам другого запуска.
+    """
+    old, new = flatten(baseline['results']), flatten(current['results'])
+    print(f"\n=== Сравнение с {baseline.get('commit')} ===")
+    for name in sorted(old.keys() & new.keys()):
+        if old[name]:
+            print(f"{name:<45} {old[name]:>14.3f} -> {new[name]:>14.3f}  x{new[name] / old[name]:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки RAG системы")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100],
+                        help="Во сколько раз увеличивать корпус")
+    parser.add_argument("--repeats", type=int, default=20, help="Число повторов набора запросов при замере поиска")
+    parser.add_argument("--scoring-cases", type=int, default=3000, help="Число ответов при замере оценки")
+    parser.add_argument("--output", default="bench_results.json", help="Файл для результатов")
+    parser.add_argument("--compare", help="Файл с результатами другого запуска для сравнения")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    report = run(args.scales, args.repeats, args.scoring_cases)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты сохранены в {args.output}")
+
+    if baseline is not None:
+        compare(baseline, report)
+
+
+if __name__ == "__main__":
+    main()
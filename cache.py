@@ -0,0 +1,556 @@
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from collections import OrderedDict
+import numpy as np
+import threading
+import hashlib
+import sqlite3
+import json
+import time
+import re
+
+
+def normalize_question(text):
+    """
+    Приводит вопрос к нормальной форме для точного поиска в кэше:
+    нижний регистр, ё -> е, без знаков препинания и лишних пробелов.
+
+    Args:
+        text (str): Вопрос пользователя
+
+    Returns:
+        str: Нормализованный вопрос
+    """
+    text = text.lower().replace('ё', 'е')
+    text = re.sub(r'[^\w\s-]', ' ', text)
+    return ' '.join(text.split())
+
+
+def serialize_responses(responses):
+    """
+    Переводит список ответов в JSON-строку (источники -- в словари).
+
+    Args:
+        responses (list): Список словарей с ответами и их метриками
+
+    Returns:
+        str: JSON-представление ответов
+    """
+    return json.dumps([
+        {**resp, 'sources': [{'page_content': s.page_content, 'metadata': s.metadata} for s in resp['sources']]}
+        for resp in responses
+    ], ensure_ascii=False)
+
+
+def deserialize_responses(payload):
+    """
+    Восстанавливает список ответов из JSON-строки.
+
+    Args:
+        payload (str): JSON-представление ответов
+
+    Returns:
+        list: Список словарей с ответами и их метриками
+    """
+    return [
+        {**resp, 'sources': [Document(**s) for s in resp['sources']]}
+        for resp in json.loads(payload)
+    ]
+
+
+def open_db(db_path, schema):
+    """
+    Открывает файл SQLite, доступный из нескольких потоков, и создает таблицу кэша.
+
+    Args:
+        db_path (str): Путь к файлу SQLite
+        schema (str): SQL-запрос создания таблицы
+
+    Returns:
+        sqlite3.Connection: Соединение с базой
+    """
+    db = sqlite3.connect(db_path, check_same_thread=False)
+    db.execute(schema)
+    db.commit()
+    return db
+
+
+class AnswerCache:
+    """
+    Двухуровневый кэш ответов RAG системы.
+
+    Первый уровень -- точное совпадение нормализованного вопроса, второй --
+    семантический поиск по эмбеддингу вопроса с порогом косинусной близости.
+    Записи вытесняются по TTL и LRU. Опционально записи сохраняются в SQLite
+    и переживают перезапуск; записи, построенные по другому отпечатку корпуса,
+    при загрузке удаляются.
+    """
+
+    def __init__(self, embed_fn=None, fingerprint=None, max_size=1024, ttl=3600,
+                 similarity_threshold=0.95, db_path=None):
+        """
+        Args:
+            embed_fn: Функция, возвращающая нормированный эмбеддинг текста
+                (None -- семантический уровень отключен)
+            fingerprint (str): Отпечаток корпуса, к которому привязаны ответы
+            max_size (int): Максимальное число записей
+            ttl (float): Время жизни записи в секундах
+            similarity_threshold (float): Порог косинусной близости для семантического попадания
+            db_path (str): Путь к файлу SQLite (None -- кэш только в памяти)
+        """
+        self.embed_fn = embed_fn
+        self.fingerprint = fingerprint
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'exact_hits': 0, 'semantic_hits': 0, 'misses': 0}
+
+        self._keys = []
+        self._matrix = None
+
+        self.db = None
+        if db_path is not None:
+            self.db = open_db(
+                db_path,
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "key TEXT PRIMARY KEY, num_attempts INTEGER, fingerprint TEXT, "
+                "created REAL, embedding BLOB, payload TEXT)"
+            )
+            self._load()
+
+    @staticmethod
+    def make_prefix(num_attempts, variant=""):
+        """
+        Returns:
+            str: Группа записей с тем же числом попыток и режимом; семантический поиск идет только внутри группы
+        """
+        return f"{num_attempts}{variant}"
+
+    @classmethod
+    def make_key(cls, question, num_attempts, variant=""):
+        return f"{cls.make_prefix(num_attempts, variant)}:{normalize_question(question)}"
+
+    def _load(self):
+        """
+        Загружает из SQLite актуальные записи и удаляет устаревшие.
+        """
+        deadline = time.time() - self.ttl
+        self.db.execute("DELETE FROM answers WHERE fingerprint IS NOT ? OR created < ?", (self.fingerprint, deadline))
+        self.db.commit()
+
+        rows = self.db.execute(
+            "SELECT key, num_attempts, created, embedding, payload FROM answers ORDER BY created"
+        ).fetchall()
+        for key, num_attempts, created, embedding, payload in rows[-self.max_size:]:
+            self.entries[key] = {
+                # в нормализованном вопросе нет ':', а в режиме (например, фильтре метаданных) может быть
+                'prefix': key.rsplit(':', 1)[0],
+                'created': created,
+                'embedding': np.frombuffer(embedding, dtype=np.float32) if embedding else None,
+                'responses': deserialize_responses(payload),
+            }
+        self._matrix = None
+
+    def _evict(self, key):
+        del self.entries[key]
+        self._matrix = None
+        if self.db is not None:
+            self.db.execute("DELETE FROM answers WHERE key = ?", (key,))
+            self.db.commit()
+
+    def _expired(self, entry):
+        return time.time() - entry['created'] > self.ttl
+
+    def _semantic_lookup(self, embedding, prefix):
+        """
+        Ищет запись с наиболее близким эмбеддингом вопроса среди записей
+        с тем же числом попыток и режимом (префиксом ключа).
+
+        Returns:
+            str: Ключ найденной записи или None
+        """
+        if self._matrix is None:
+            self._keys = [k for k, e in self.entries.items() if e['embedding'] is not None]
+            self._matrix = np.vstack([self.entries[k]['embedding'] for k in self._keys]) if self._keys else None
+        if self._matrix is None:
+            return None
+
+        similarities = self._matrix @ embedding
+        for i in np.argsort(-similarities):
+            if similarities[i] < self.similarity_threshold:
+                break
+            entry = self.entries.get(self._keys[i])
+            if entry is not None and entry['prefix'] == prefix and not self._expired(entry):
+                return self._keys[i]
+
+        return None
+
+    def get(self, question, num_attempts, variant=""):
+        """
+        Ищет ответы на вопрос в кэше: сначала точное совпадение, затем семантическое.
+
+        Args:
+            question (str): Вопрос пользователя
+            num_attempts (int): Количество попыток получения ответа
+            variant (str): Режим получения ответов (записи разных режимов не смешиваются)
+
+        Returns:
+            tuple: (список ответов или None, эмбеддинг вопроса или None);
+                эмбеддинг можно передать в put, чтобы не считать его повторно
+        """
+        key = self.make_key(question, num_attempts, variant)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._evict(key)
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.counters['exact_hits'] += 1
+                return entry['responses'], None
+
+        if self.embed_fn is None:
+            with self.lock:
+                self.counters['misses'] += 1
+            return None, None
+
+        embedding = np.asarray(self.embed_fn(normalize_question(question)), dtype=np.float32)
+
+        with self.lock:
+            found = self._semantic_lookup(embedding, self.make_prefix(num_attempts, variant))
+            if found is None:
+                self.counters['misses'] += 1
+                return None, embedding
+
+            self.entries.move_to_end(found)
+            self.counters['semantic_hits'] += 1
+            return self.entries[found]['responses'], embedding
+
+    def put(self, question, num_attempts, responses, embedding=None, variant=""):
+        """
+        Сохраняет ответы на вопрос в кэш.
+
+        Args:
+            question (str): Вопрос пользователя
+            num_attempts (int): Количество попыток получения ответа
+            responses (list): Список словарей с ответами и их метриками
+            embedding (np.ndarray): Эмбеддинг вопроса, полученный из get
+            variant (str): Режим получения ответов
+        """
+        key = self.make_key(question, num_attempts, variant)
+        if embedding is None and self.embed_fn is not None:
+            embedding = np.asarray(self.embed_fn(normalize_question(question)), dtype=np.float32)
+
+        entry = {
+            'prefix': self.make_prefix(num_attempts, variant),
+            'created': time.time(),
+            'embedding': embedding,
+            'responses': responses,
+        }
+
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self._matrix = None
+
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, num_attempts, self.fingerprint, entry['created'],
+                     embedding.tobytes() if embedding is not None else None,
+                     serialize_responses(responses))
+                )
+                self.db.commit()
+
+            while len(self.entries) > self.max_size:
+                self._evict(next(iter(self.entries)))
+
+    def stats(self):
+        """
+        Returns:
+            dict: Счетчики попаданий и промахов, доля попаданий и размер кэша
+        """
+        with self.lock:
+            hits = self.counters['exact_hits'] + self.counters['semantic_hits']
+            total = hits + self.counters['misses']
+            return {
+                **self.counters,
+                'hit_rate': hits / total if total else 0.0,
+                'size': len(self.entries),
+            }
+
+
+class ParaphraseCache:
+    """
+    LRU-кэш перефразировок вопросов, полученных от LLM.
+
+    Для пары (вопрос, модель) хранится самый большой из полученных наборов
+    перефразировок, поэтому запрос меньшего числа перефразировок обслуживается
+    из уже сохраненного большего набора. Опционально записи сохраняются в SQLite.
+    """
+
+    def __init__(self, max_size=512, db_path=None):
+        """
+        Args:
+            max_size (int): Максимальное число записей
+            db_path (str): Путь к файлу SQLite (None -- кэш только в памяти)
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0}
+
+        self.db = None
+        if db_path is not None:
+            self.db = open_db(
+                db_path,
+                "CREATE TABLE IF NOT EXISTS paraphrases ("
+                "key TEXT PRIMARY KEY, requested INTEGER, created REAL, queries TEXT)"
+            )
+            rows = self.db.execute("SELECT key, requested, queries FROM paraphrases ORDER BY created").fetchall()
+            for key, requested, queries in rows[-max_size:]:
+                self.entries[key] = {'requested': requested, 'queries': json.loads(queries)}
+
+    @staticmethod
+    def make_key(question, model):
+        return f"{model}:{normalize_question(question)}"
+
+    def get(self, question, num_attempts, model):
+        """
+        Возвращает перефразировки вопроса, если в кэше есть набор не меньшего размера.
+
+        Args:
+            question (str): Исходный вопрос
+            num_attempts (int): Требуемое число вариантов (вместе с исходным вопросом)
+            model (str): Название модели, выполнявшей перефразирование
+
+        Returns:
+            list: Исходный вопрос и его перефразировки или None
+        """
+        key = self.make_key(question, model)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry['requested'] < num_attempts:
+                self.counters['misses'] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return [question] + entry['queries'][1:num_attempts]
+
+    def put(self, question, num_attempts, model, queries):
+        """
+        Сохраняет перефразировки вопроса, если их набор больше уже сохраненного.
+
+        Args:
+            question (str): Исходный вопрос
+            num_attempts (int): Запрошенное число вариантов (вместе с исходным вопросом)
+            model (str): Название модели, выполнявшей перефразирование
+            queries (list): Исходный вопрос и его перефразировки
+        """
+        key = self.make_key(question, model)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['requested'] >= num_attempts:
+                return
+
+            self.entries[key] = {'requested': num_attempts, 'queries': list(queries)}
+            self.entries.move_to_end(key)
+
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO paraphrases VALUES (?, ?, ?, ?)",
+                    (key, num_attempts, time.time(), json.dumps(list(queries), ensure_ascii=False))
+                )
+
+            while len(self.entries) > self.max_size:
+                evicted, _ = self.entries.popitem(last=False)
+                if self.db is not None:
+                    self.db.execute("DELETE FROM paraphrases WHERE key = ?", (evicted,))
+
+            if self.db is not None:
+                self.db.commit()
+
+    def stats(self):
+        """
+        Returns:
+            dict: Счетчики попаданий и промахов и размер кэша
+        """
+        with self.lock:
+            return {**self.counters, 'size': len(self.entries)}
+
+
+def text_key(text):
+    """
+    Returns:
+        str: SHA-1 текста, по которому в кэше хранится его эмбеддинг
+    """
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Модель эмбеддингов с кэшем векторов по хешу текста.
+
+    Эмбеддинги документов (чанков корпуса) хранятся в SQLite без ограничения
+    размера, поэтому повторная индексация после правки корпуса или смены типа
+    индекса вычисляет эмбеддинги только для новых текстов. Эмбеддинги запросов
+    хранятся в LRU-кэше ограниченного размера и тоже сохраняются в SQLite.
+    Модель вызывается только при промахе, поэтому попадания в кэш не ждут
+    загрузки модели, обернутой в BackgroundEmbeddings.
+    """
+
+    def __init__(self, embeddings, model_name, db_path=None, max_queries=4096):
+        """
+        Args:
+            embeddings: Модель эмбеддингов
+            model_name (str): Название модели (векторы разных моделей не смешиваются)
+            db_path (str): Путь к файлу SQLite (None -- кэшируются только запросы и только в памяти)
+            max_queries (int): Максимальное число эмбеддингов запросов в кэше
+                (0 -- запросы не кэшируются, например для замеров задержки поиска)
+        """
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_queries = max_queries
+
+        self.queries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'document_hits': 0, 'document_misses': 0, 'query_hits': 0, 'query_misses': 0}
+
+        self.db = None
+        if db_path is not None:
+            self.db = open_db(
+                db_path,
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT, kind TEXT, key TEXT, created REAL, vector BLOB, "
+                "PRIMARY KEY (model, kind, key))"
+            )
+        if self.db is not None and max_queries > 0:
+            rows = self.db.execute(
+                "SELECT key, vector FROM embeddings WHERE model = ? AND kind = 'query' ORDER BY created",
+                (model_name,)
+            ).fetchall()
+            for key, vector in rows[-max_queries:]:
+                self.queries[key] = np.frombuffer(vector, dtype=np.float32)
+
+    def _fetch_documents(self, keys):
+        """
+        Читает из SQLite сохраненные эмбеддинги документов (вызывается под self.lock).
+
+        Returns:
+            dict: Хеш текста -> вектор float32
+        """
+        found = {}
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            rows = self.db.execute(
+                "SELECT key, vector FROM embeddings WHERE model = ? AND kind = 'document' "
+                f"AND key IN ({', '.join('?' * len(part))})",
+                (self.model_name, *part)
+            ).fetchall()
+            found.update((key, np.frombuffer(vector, dtype=np.float32)) for key, vector in rows)
+        return found
+
+    def _save(self, kind, vectors):
+        # вызывается под self.lock
+        created = time.time()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)",
+            [(self.model_name, kind, key, created, vector.tobytes()) for key, vector in vectors.items()]
+        )
+
+    def embed_documents(self, texts):
+        """
+        Эмбеддинги документов: сохраненные берутся из SQLite, остальные
+        вычисляются моделью одним батчем и сохраняются.
+        """
+        if self.db is None:
+            return self.embeddings.embed_documents(texts)
+
+        keys = [text_key(text) for text in texts]
+        with self.lock:
+            found = self._fetch_documents(list(set(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+
+        if missing:
+            vectors = np.asarray(self.embeddings.embed_documents(list(missing.values())), dtype=np.float32)
+            computed = dict(zip(missing, vectors))
+            found.update(computed)
+            with self.lock:
+                self._save('document', computed)
+                self.db.commit()
+
+        with self.lock:
+            self.counters['document_hits'] += len(texts) - len(missing)
+            self.counters['document_misses'] += len(missing)
+        return [found[key].tolist() for key in keys]
+
+    def embed_queries(self, texts):
+        """
+        Эмбеддинги пакета запросов через LRU-кэш; промахи вычисляются моделью одним батчем.
+        Запросы кодируются так же, как документы (так поиск всегда работал с моделью LaBSE).
+        """
+        if self.max_queries <= 0:
+            with self.lock:
+                self.counters['query_misses'] += len(texts)
+            return self.embeddings.embed_documents(texts)
+
+        keys = [text_key(text) for text in texts]
+        found = {}
+        with self.lock:
+            for key in keys:
+                vector = self.queries.get(key)
+                if vector is not None:
+                    self.queries.move_to_end(key)
+                    found[key] = vector
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+
+        computed = {}
+        if missing:
+            vectors = np.asarray(self.embeddings.embed_documents(list(missing.values())), dtype=np.float32)
+            computed = dict(zip(missing, vectors))
+            found.update(computed)
+
+        with self.lock:
+            self.counters['query_hits'] += len(texts) - len(missing)
+            self.counters['query_misses'] += len(missing)
+            self.queries.update(computed)
+            evicted = []
+            while len(self.queries) > self.max_queries:
+                evicted.append(self.queries.popitem(last=False)[0])
+
+            if self.db is not None and (computed or evicted):
+                self._save('query', computed)
+                self.db.executemany(
+                    "DELETE FROM embeddings WHERE model = ? AND kind = 'query' AND key = ?",
+                    [(self.model_name, key) for key in evicted]
+                )
+                self.db.commit()
+
+        return [found[key].tolist() for key in keys]
+
+    def embed_query(self, text):
+        return self.embed_queries([text])[0]
+
+    def stats(self):
+        """
+        Returns:
+            dict: Счетчики попаданий и промахов для документов и запросов, число запросов в кэше
+        """
+        with self.lock:
+            return {**self.counters, 'queries': len(self.queries)}
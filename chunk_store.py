@@ -0,0 +1,268 @@
+from langchain_core.documents import Document
+
+from collections.abc import Sequence
+import numpy as np
+import shutil
+import json
+import mmap
+import os
+
+
+STORE_FORMAT = 3
+
+
+class ChunkStore(Sequence):
+    """
+    Компактное хранилище чанков корпуса.
+
+    Тексты всех чанков лежат на диске одним непрерывным UTF-8 блобом, рядом --
+    массивы смещений, позиций в исходном файле, chunk_id и номеров документов
+    корпуса (серий и биографий), из которых взяты чанки. Все файлы отображаются
+    в память (mmap), поэтому резидентная память близка к размеру самого корпуса
+    и разделяется между процессами, а объекты Document создаются только
+    при обращении к конкретному чанку.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Папка хранилища (см. ChunkStore.build)
+        """
+        self.path = path
+        with open(os.path.join(path, "meta.json"), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.source = self.meta['source']
+        self.documents = self.meta.get('documents') or []
+
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode='r')
+        self.starts = np.load(os.path.join(path, "starts.npy"), mmap_mode='r')
+        self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode='r')
+        self.docs = np.load(os.path.join(path, "docs.npy"), mmap_mode='r')
+
+        with open(os.path.join(path, "chunks.bin"), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+        self._positions = None
+
+    @classmethod
+    def build(cls, path, docs, key=None, documents=None):
+        """
+        Записывает поток чанков в хранилище, не держа их тексты в памяти.
+        Хранилище сначала записывается во временную папку и подменяет старое
+        только целиком, поэтому процессы, читающие старое хранилище, не ломаются.
+
+        Args:
+            path (str): Папка хранилища
+            docs (iterable): Поток документов с metadata['chunk_id'], metadata['start_index'],
+                metadata['source'] и, если корпус размечен, metadata['document']
+            key (dict): Описание корпуса и параметров разбиения, по которому
+                хранилище проверяется при открытии (см. ChunkStore.open)
+            documents (list): Описания документов корпуса (см. utils.read_corpus_documents)
+
+        Returns:
+            ChunkStore: Открытое хранилище
+        """
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        offsets, starts, ids, doc_numbers = [0], [], [], []
+        source = None
+        with open(os.path.join(tmp_path, "chunks.bin"), 'wb') as f:
+            for doc in docs:
+                data = doc.page_content.encode('utf-8')
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+                starts.append(doc.metadata.get('start_index', -1))
+                ids.append(doc.metadata['chunk_id'])
+                doc_numbers.append(doc.metadata.get('document', -1))
+                source = doc.metadata.get('source', source)
+
+        np.save(os.path.join(tmp_path, "offsets.npy"), np.array(offsets, dtype=np.int64))
+        np.save(os.path.join(tmp_path, "starts.npy"), np.array(starts, dtype=np.int64))
+        np.save(os.path.join(tmp_path, "ids.npy"), np.array(ids, dtype='S') if ids else np.empty(0, dtype='S1'))
+        np.save(os.path.join(tmp_path, "docs.npy"), np.array(doc_numbers, dtype=np.int32))
+
+        meta = {'format': STORE_FORMAT, 'key': key, 'source': source, 'count': len(ids),
+                'documents': documents or []}
+        with open(os.path.join(tmp_path, "meta.json"), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+        # метаданные удаляются первыми и переносятся последними: их наличие означает,
+        # что хранилище записано целиком
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        for name in ("chunks.bin", "offsets.npy", "starts.npy", "ids.npy", "docs.npy", "meta.json"):
+            os.replace(os.path.join(tmp_path, name), os.path.join(path, name))
+        os.rmdir(tmp_path)
+
+        return cls(path)
+
+    @classmethod
+    def open(cls, path, key=None):
+        """
+        Открывает хранилище, если оно записано целиком и построено для того же корпуса.
+
+        Args:
+            path (str): Папка хранилища
+            key (dict): Ожидаемое описание корпуса и параметров разбиения
+                (None -- открыть хранилище, построенное для любого корпуса)
+
+        Returns:
+            ChunkStore: Хранилище или None
+        """
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('format') != STORE_FORMAT or (key is not None and meta.get('key') != key):
+            return None
+        return cls(path)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def text(self, i):
+        """
+        Returns:
+            str: Текст i-го чанка
+        """
+        return self.blob[int(self.offsets[i]):int(self.offsets[i + 1])].decode('utf-8')
+
+    def chunk_id(self, i):
+        return self.ids[i].decode('ascii')
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+
+        metadata = {'source': self.source, 'chunk_id': self.chunk_id(i)}
+        if self.starts[i] >= 0:
+            metadata['start_index'] = int(self.starts[i])
+        if self.docs[i] >= 0:
+            metadata.update(self.documents[self.docs[i]]['metadata'])
+        return Document(page_content=self.text(i), metadata=metadata)
+
+    def iter_texts(self):
+        """
+        Yields:
+            str: Тексты чанков по порядку (без создания Document)
+        """
+        for i in range(len(self)):
+            yield self.text(i)
+
+    @property
+    def chunk_ids(self):
+        """
+        Returns:
+            list: chunk_id всех чанков по порядку
+        """
+        return [cid.decode('ascii') for cid in self.ids]
+
+    def position(self, chunk_id):
+        """
+        Returns:
+            int: Номер чанка с данным chunk_id или None
+        """
+        if self._positions is None:
+            self._positions = {cid: i for i, cid in enumerate(self.chunk_ids)}
+        return self._positions.get(chunk_id)
+
+    def get(self, chunk_id):
+        """
+        Returns:
+            Document: Чанк с данным chunk_id или None
+        """
+        i = self.position(chunk_id)
+        return self[i] if i is not None else None
+
+    def document_chunks(self, document):
+        """
+        Args:
+            document (int): Номер документа корпуса
+
+        Returns:
+            range: Номера чанков документа (чанки документа идут подряд)
+        """
+        first = int(np.searchsorted(self.docs, document, side='left'))
+        last = int(np.searchsorted(self.docs, document, side='right'))
+        return range(first, last)
+
+    def select(self, metadata_filter):
+        """
+        Находит чанки документов с подходящими метаданными.
+
+        Args:
+            metadata_filter (dict): Поле метаданных документа -> значение или список
+                допустимых значений, например {'season': 3} или {'hero': ['Джон Сноу', 'Арья Старк']}
+
+        Returns:
+            np.ndarray: Номера подходящих чанков по возрастанию
+        """
+        selected = [
+            n for n, document in enumerate(self.documents)
+            if matches_filter(document['metadata'], metadata_filter)
+        ]
+        if not selected:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(r.start, r.stop, dtype=np.int64)
+                               for r in map(self.document_chunks, selected)])
+
+    @property
+    def nbytes(self):
+        """
+        Returns:
+            int: Размер хранилища в байтах (блоб и массивы)
+        """
+        return len(self.blob) + self.offsets.nbytes + self.starts.nbytes + self.ids.nbytes + self.docs.nbytes
+
+    def close(self):
+        """
+        Освобождает отображенные в память файлы хранилища.
+        """
+        if isinstance(self.blob, mmap.mmap):
+            self.blob.close()
+        self.blob = b''
+        self.offsets = self.starts = self.docs = np.empty(0, dtype=np.int64)
+        self.ids = np.empty(0, dtype='S1')
+
+
+def matches_filter(metadata, metadata_filter):
+    """
+    Returns:
+        bool: Метаданные удовлетворяют всем условиям фильтра (см. ChunkStore.select)
+    """
+    for key, value in metadata_filter.items():
+        allowed = value if isinstance(value, (list, tuple, set)) else [value]
+        if metadata.get(key) not in allowed:
+            return False
+    return True
+
+
+class ChunkDocstore:
+    """
+    Docstore для FAISS поверх ChunkStore: документы по chunk_id создаются
+    при обращении и не сериализуются вместе с индексом.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def search(self, search):
+        doc = self.store.get(search)
+        return doc if doc is not None else f"ID {search} not found."
+
+    def add(self, texts):
+        # тексты чанков уже лежат в хранилище
+        pass
+
+    def delete(self, ids):
+        pass
@@ -0,0 +1,150 @@
+import argparse
+import hashlib
+import json
+import os
+
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+EPISODES_DIR = os.path.join(DATA_DIR, "game_of_thrones_episodes")
+HEROES_DIR = os.path.join(DATA_DIR, "game_of_thrones_heroes")
+OUTPUT_PATH = os.path.join(DATA_DIR, "all_content.txt")
+
+CORPUS_FORMAT = 1
+
+
+def text_digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def iter_sources(episodes_dir=EPISODES_DIR, heroes_dir=HEROES_DIR):
+    """
+    Перечисляет файлы, собранные парсерами, в порядке их следования в корпусе:
+    сначала серии по номеру, затем биографии по имени персонажа.
+
+    Yields:
+        tuple: (путь к файлу, метаданные документа)
+    """
+    episodes = [f for f in os.listdir(episodes_dir) if f.endswith('.txt')] if os.path.isdir(episodes_dir) else []
+    # Сортируем файлы по номеру серии
+    episodes.sort(key=lambda x: int(x.split('.')[0]))
+    for file in episodes:
+        number, title = file[:-len('.txt')].split('.', 1)
+        yield os.path.join(episodes_dir, file), {'kind': 'episode', 'episode': int(number), 'title': title}
+
+    heroes = sorted(f for f in os.listdir(heroes_dir) if f.endswith('.txt')) if os.path.isdir(heroes_dir) else []
+    for file in heroes:
+        yield os.path.join(heroes_dir, file), {'kind': 'hero', 'hero': file[:-len('.txt')]}
+
+
+def document_text(content, metadata):
+    """
+    Returns:
+        str: Документ в том виде, в котором он записывается в корпус (с заголовком)
+    """
+    if metadata['kind'] == 'episode':
+        return f"Серия {metadata['episode']}\n{content}"
+    return f"{metadata['hero']}\n\n{content}"
+
+
+def read_previous(documents_path):
+    try:
+        with open(documents_path, 'r', encoding='utf-8') as f:
+            corpus = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if corpus.get('format') != CORPUS_FORMAT:
+        return {}
+    return {document['file']: document['digest'] for document in corpus['documents']}
+
+
+def build_corpus(output_path=OUTPUT_PATH, episodes_dir=EPISODES_DIR, heroes_dir=HEROES_DIR, force=False):
+    """
+    Собирает корпус из файлов серий и биографий.
+
+    Файлы читаются и записываются в корпус по одному. Рядом с корпусом записывается
+    описание документов (all_content.txt -> all_content.json): позиции в корпусе,
+    хеши и метаданные (номер и название серии, имя персонажа). По нему
+    utils.load_or_build_store разбивает заново только изменившиеся документы,
+    а эмбеддинги пересчитываются только для их чанков. Если ни один документ
+    не изменился, корпус не перезаписывается.
+
+    Формат корпуса совпадает с прежним: серии в виде "Серия N" и текста
+    с пустой строкой после каждой серии, затем через пустую строку биографии
+    в виде имени и текста, разделенные двумя пустыми строками.
+
+    Args:
+        output_path (str): Путь к файлу корпуса
+        episodes_dir (str): Папка с файлами серий (см. episodes_parser.py)
+        heroes_dir (str): Папка с биографиями (см. heroes_parser.py)
+        force (bool): Перезаписать корпус, даже если документы не изменились
+
+    Returns:
+        dict: Число документов: всего, новых, измененных, удаленных
+    """
+    documents_path = os.path.splitext(output_path)[0] + ".json"
+    previous = read_previous(documents_path)
+
+    documents = []
+    digest = hashlib.sha1()
+    position = 0
+    tmp_path = f"{output_path}.tmp"
+
+    with open(tmp_path, 'w', encoding='utf-8', newline='\n') as outfile:
+        def write(text):
+            nonlocal position
+            outfile.write(text)
+            digest.update(text.encode('utf-8'))
+            position += len(text)
+
+        previous_kind = None
+        for path, metadata in iter_sources(episodes_dir, heroes_dir):
+            with open(path, 'r', encoding='utf-8') as infile:
+                content = infile.read()
+
+            if metadata['kind'] == 'hero':
+                # биографии отделены от серий и друг от друга двумя пустыми строками
+                write('\n\n' if previous_kind == 'episode' else '\n\n\n' if previous_kind == 'hero' else '')
+            text = document_text(content, metadata)
+
+            documents.append({
+                'file': os.path.relpath(path, os.path.dirname(os.path.abspath(output_path))).replace(os.sep, '/'),
+                'digest': text_digest(text),
+                'start': position,
+                'length': len(text),
+                'metadata': metadata,
+            })
+            write(text)
+            if metadata['kind'] == 'episode':
+                write('\n\n')
+            previous_kind = metadata['kind']
+
+    current = {document['file']: document['digest'] for document in documents}
+    stats = {
+        'documents': len(documents),
+        'added': sum(1 for file in current if file not in previous),
+        'changed': sum(1 for file, d in current.items() if file in previous and previous[file] != d),
+        'removed': sum(1 for file in previous if file not in current),
+    }
+
+    if not force and os.path.exists(output_path) and current == previous:
+        os.remove(tmp_path)
+        print(f"Корпус не изменился: {len(documents)} документов")
+        return stats
+
+    os.replace(tmp_path, output_path)
+    with open(documents_path, 'w', encoding='utf-8') as f:
+        json.dump({'format': CORPUS_FORMAT, 'digest': digest.hexdigest(), 'documents': documents},
+                  f, ensure_ascii=False, indent=1)
+
+    print(f"Корпус собран в {output_path}: {stats['documents']} документов "
+          f"(новых {stats['added']}, измененных {stats['changed']}, удаленных {stats['removed']})")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сборка корпуса из серий и биографий")
+    parser.add_argument("--output", default=OUTPUT_PATH, help="Файл корпуса")
+    parser.add_argument("--force", action="store_true", help="Перезаписать корпус, даже если документы не изменились")
+    args = parser.parse_args()
+
+    build_corpus(args.output, force=args.force)
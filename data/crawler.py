@@ -0,0 +1,283 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import hashlib
+import json
+import time
+import os
+
+
+BASE_URL = "https://gameofthrones.fandom.com/ru/wiki/"
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+# число одновременных запросов к сайту: больше не ускоряет загрузку, а только нагружает wiki
+DEFAULT_WORKERS = 8
+
+
+class HttpFetcher:
+    """
+    Загрузка страниц через общий requests.Session: соединения переиспользуются
+    всеми потоками, временные ошибки сервера повторяются с экспоненциальной задержкой.
+
+    Любой другой загрузчик для crawl -- это функция fetch(url, headers),
+    возвращающая (код ответа, текст, заголовки ответа), например заглушка,
+    отдающая сохраненные страницы.
+    """
+
+    def __init__(self, max_workers=DEFAULT_WORKERS, retries=3, timeout=30):
+        """
+        Args:
+            max_workers (int): Размер пула соединений (по числу потоков загрузки)
+            retries (int): Число повторов при ошибках соединения и ответах 429/5xx
+            timeout (float): Таймаут запроса в секундах
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.timeout = timeout
+
+    def __call__(self, url, headers=None):
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        if response.status_code != 304:
+            response.raise_for_status()
+        return response.status_code, response.text, response.headers
+
+    def close(self):
+        self.session.close()
+
+
+class HtmlCache:
+    """
+    Кэш исходного HTML страниц на диске вместе с ETag и Last-Modified ответа,
+    по которым выполняются условные повторные запросы.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, url, ext):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + ext)
+
+    def get(self, url):
+        """
+        Returns:
+            tuple: (HTML, валидаторы ответа) или None, если страницы нет в кэше
+        """
+        try:
+            with open(self._path(url, ".html"), 'r', encoding='utf-8') as f:
+                html = f.read()
+            with open(self._path(url, ".json"), 'r', encoding='utf-8') as f:
+                validators = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return html, validators
+
+    def put(self, url, html, response_headers):
+        validators = {
+            'url': url,
+            'etag': response_headers.get('ETag'),
+            'last_modified': response_headers.get('Last-Modified'),
+        }
+        # HTML записывается первым: валидаторы без HTML не дадут ответа 304 на пустой кэш
+        write_atomic(self._path(url, ".html"), html)
+        write_atomic(self._path(url, ".json"), json.dumps(validators, ensure_ascii=False))
+
+
+class Manifest:
+    """
+    Журнал обработанных страниц. Сохраняется после каждой страницы, поэтому
+    прерванный сбор продолжается с места остановки, а при повторном запуске
+    заново загружаются только страницы, завершившиеся ошибкой.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.pages = json.load(f)
+        except (OSError, ValueError):
+            self.pages = {}
+
+    def done(self, page):
+        """
+        Returns:
+            bool: Страница уже обработана и ее результат на месте
+        """
+        with self.lock:
+            entry = self.pages.get(page)
+        return bool(entry) and entry['status'] == 'done' and os.path.exists(entry['output'])
+
+    def get(self, page):
+        with self.lock:
+            return self.pages.get(page, {})
+
+    def update(self, page, **entry):
+        with self.lock:
+            self.pages[page] = {**entry, 'updated': time.time()}
+            write_atomic(self.path, json.dumps(self.pages, ensure_ascii=False, indent=2))
+
+
+def write_atomic(path, text):
+    """
+    Записывает файл целиком: при прерывании на диске остается старая версия, а не обрывок.
+    """
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def fetch_html(url, fetcher, cache, refresh):
+    """
+    Возвращает HTML страницы: из кэша или по сети, условным запросом, если страница уже есть в кэше.
+
+    Returns:
+        tuple: (HTML, источник: 'cache', 'not_modified' или 'network')
+    """
+    cached = cache.get(url)
+    if cached is not None and not refresh:
+        return cached[0], 'cache'
+
+    headers = {}
+    if cached is not None:
+        if cached[1].get('etag'):
+            headers['If-None-Match'] = cached[1]['etag']
+        if cached[1].get('last_modified'):
+            headers['If-Modified-Since'] = cached[1]['last_modified']
+
+    status, html, response_headers = fetcher(url, headers)
+    if status == 304 and cached is not None:
+        return cached[0], 'not_modified'
+
+    cache.put(url, html, response_headers)
+    return html, 'network'
+
+
+def crawl(pages, parse, output_dir, base_url=BASE_URL, cache_dir=None, manifest_path=None,
+          max_workers=DEFAULT_WORKERS, refresh=False, fetcher=None):
+    """
+    Параллельно загружает и разбирает страницы wiki.
+
+    Страницы, уже обработанные в прошлых запусках, пропускаются без обращения к сети.
+    С refresh=True все страницы проверяются условными запросами (If-None-Match,
+    If-Modified-Since), и заново разбираются только изменившиеся.
+
+    Args:
+        pages (list): Названия страниц (часть URL после base_url)
+        parse (callable): Функция parse(html, index) -> (имя файла, текст); index -- номер страницы в pages
+        output_dir (str): Папка для текстовых файлов
+        base_url (str): Адрес wiki
+        cache_dir (str): Папка кэша HTML (по умолчанию <output_dir>/.html_cache)
+        manifest_path (str): Файл журнала (по умолчанию <output_dir>/manifest.json)
+        max_workers (int): Число одновременных запросов
+        refresh (bool): Проверить на сайте изменения уже обработанных страниц
+        fetcher (callable): Загрузчик fetch(url, headers) (по умолчанию HttpFetcher)
+
+    Returns:
+        dict: Число страниц по исходам: пропущено, из кэша, не изменилось, загружено, ошибок
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    cache = HtmlCache(cache_dir or os.path.join(output_dir, ".html_cache"))
+    manifest = Manifest(manifest_path or os.path.join(output_dir, "manifest.json"))
+    own_fetcher = fetcher is None
+    if own_fetcher:
+        fetcher = HttpFetcher(max_workers=max_workers)
+
+    def process(index, page):
+        url = base_url + page
+        html, source = fetch_html(url, fetcher, cache, refresh)
+        output = manifest.get(page).get('output')
+        if source == 'not_modified' and output and os.path.exists(output):
+            return source
+
+        filename, text = parse(html, index)
+        output = os.path.join(output_dir, filename)
+        write_atomic(output, text)
+        manifest.update(page, url=url, output=output, status='done')
+        return source
+
+    stats = {'skipped': 0, 'cache': 0, 'not_modified': 0, 'network': 0, 'errors': 0}
+    todo = [(i, page) for i, page in enumerate(pages) if refresh or not manifest.done(page)]
+    stats['skipped'] = len(pages) - len(todo)
+
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(process, i, page): page for i, page in todo}
+            for future in as_completed(futures):
+                page = futures[future]
+                try:
+                    stats[future.result()] += 1
+                except Exception as e:
+                    stats['errors'] += 1
+                    manifest.update(page, url=base_url + page, output=None, status='error', error=str(e))
+                    print(f"Ошибка при обработке страницы {page}: {e}")
+    finally:
+        if own_fetcher:
+            fetcher.close()
+
+    print(f"Обработано страниц: {len(pages)} за {time.perf_counter() - start:.1f} c "
+          f"(пропущено {stats['skipped']}, из кэша {stats['cache']}, не изменилось {stats['not_modified']}, "
+          f"загружено {stats['network']}, ошибок {stats['errors']})")
+    return stats
+
+
+def parse_section(html, start_header, end_header):
+    """
+    Извлекает абзацы статьи wiki между двумя заголовками второго уровня.
+
+    Args:
+        html (str): HTML страницы
+        start_header (str): Текст заголовка, после которого начинается секция
+        end_header (str): Текст заголовка, на котором секция заканчивается
+
+    Returns:
+        tuple: (заголовок страницы, текст секции с абзацами через пустую строку)
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+    title = soup.find('h1', class_='page-header__title').text.strip()
+    content = soup.find('div', class_='mw-parser-output')
+
+    # Флаги для определения нужной секции
+    start_found = False
+    paragraphs = []
+
+    for element in content.children:
+        if element.name == 'h2' and start_header in element.text:
+            start_found = True
+            continue
+
+        if element.name == 'h2' and end_header in element.text:
+            break
+
+        if start_found and element.name == 'p':
+            text = element.get_text().strip()
+            if text:
+                paragraphs.append(text)
+
+    return title, '\n\n'.join(paragraphs)
+
+
+def add_arguments(parser):
+    """
+    Добавляет в argparse общие параметры сбора страниц.
+    """
+    parser.add_argument("--refresh", action="store_true",
+                        help="Проверить изменения уже обработанных страниц условными запросами")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Число одновременных запросов")
+    parser.add_argument("--base-url", default=BASE_URL,
+                        help="Адрес wiki (например, локальный сервер с сохраненными страницами)")
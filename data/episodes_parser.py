@@ -1,5 +1,7 @@
-import requests
-from bs4 import BeautifulSoup
+from crawler import crawl, parse_section, add_arguments
+
+import argparse
+import os
 
 episodes = [
     'Зима_близко', 'Королевский_тракт', 'Лорд_Сноу', 'Калеки,_бастарды_и_сломанные_вещи', 'Волк_и_лев', 'Золотая_корона', 'Победа_или_смерть', 'Острый_конец', 'Бейлор', 'Пламя_и_кровь',
@@ -13,52 +15,28 @@ episodes = [
 ]
 
 
-def fetch_episode_content(url, num):
-    # Настройка заголовков для запроса
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
-    
-    try:
-        # Получаем страницу
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        title = soup.find('h1', class_='page-header__title').text.strip()
-        content = soup.find('div', class_='mw-parser-output')
-        
-        # Флаги для определения нужной секции
-        start_found = False
-        plot_text = []
-        
-        for element in content.children:
-            if element.name == 'h2' and 'Краткое содержание' in element.text:
-                start_found = True
-                continue
-                
-            if element.name == 'h2' and 'Галерея' in element.text:
-                break
-                
-            if start_found and element.name == 'p':
-                text = element.get_text().strip()
-                if text:
-                    plot_text.append(text)
-        
-        # Объединяем весь текст и сохраняем
-        full_text = '\n\n'.join(plot_text)
-        
-        filename = f"game_of_thrones_episodes/{num}.{title}.txt"
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(full_text)
-            
-        print(f"Содержание серии сохранено в файл: {filename}")
-        
-    except Exception as e:
-        print(f"Произошла ошибка: {str(e)}")
+OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "game_of_thrones_episodes")
+
+
+def parse_episode(html, index):
+    """
+    Извлекает краткое содержание серии.
+
+    Args:
+        html (str): HTML страницы серии
+        index (int): Номер серии в списке episodes, начиная с нуля
+
+    Returns:
+        tuple: (имя файла вида "<номер серии>.<название>.txt", текст)
+    """
+    title, text = parse_section(html, 'Краткое содержание', 'Галерея')
+    return f"{index + 1}.{title}.txt", text
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сбор краткого содержания серий")
+    add_arguments(parser)
+    args = parser.parse_args()
 
-num = 1
-for episode in episodes:
-    url = "https://gameofthrones.fandom.com/ru/wiki/" + episode
-    fetch_episode_content(url, num)
-    num += 1
\ No newline at end of file
+    crawl(episodes, parse_episode, OUTPUT_DIR, base_url=args.base_url,
+          max_workers=args.workers, refresh=args.refresh)
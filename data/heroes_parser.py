@@ -1,5 +1,6 @@
-﻿import requests
-from bs4 import BeautifulSoup
+﻿from crawler import crawl, parse_section, add_arguments
+
+import argparse
 import os
 
 names = [
@@ -10,58 +11,28 @@ names = [
     "Рамси_Болтон", "Русе_Болтон", "Уолдер_Фрей", "Король_Ночи", "Эурон_Грейджой", "Петир_Бейлиш", "Варис", "Сэмвелл_Тарли", "Оберин_Мартелл", "Ходор"
 ]
 
-def parse_biography(url):
+OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "game_of_thrones_heroes")
+
+
+def parse_biography(html, index):
+    """
+    Извлекает биографию персонажа.
+
+    Args:
+        html (str): HTML страницы персонажа
+        index (int): Номер персонажа в списке names
 
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
-    
-    try:
-        # Получаем страницу
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # Получаем имя персонажа для названия файла
-        character_name = soup.find('h1', class_='page-header__title').text.strip()
-        
-        # Находим секцию с биографией
-        content = soup.find('div', class_='mw-parser-output')
-        start_found = False
-        biography_text = []
-        
-        for element in content.children:
+    Returns:
+        tuple: (имя файла по имени персонажа, текст)
+    """
+    character_name, text = parse_section(html, 'Биография', 'Интересные факты')
+    return f"{character_name}.txt", text
 
-            if element.name == 'h2' and 'Биография' in element.text:
-                start_found = True
-                continue
 
-            if element.name == 'h2' and 'Интересные факты' in element.text:
-                break
-                
-            # Если мы в нужной секции, собираем текст
-            if start_found and element.name == 'p':
-                text = element.get_text().strip()
-                if text:
-                    biography_text.append(text)
-        
-        # Объединяем весь текст
-        full_text = '\n\n'.join(biography_text)
-        
-        # Сохраняем в файл
-        output_folder = 'data/game_of_thrones_heroes'
-        os.makedirs(output_folder, exist_ok=True)
-        filename = os.path.join(output_folder, f"{character_name}.txt")
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(full_text)
-            
-        print(f"Биография сохранена в файл: {filename}")
-        
-        
-    except Exception as e:
-        print(f"Произошла ошибка: {str(e)}")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сбор биографий персонажей")
+    add_arguments(parser)
+    args = parser.parse_args()
 
-base_url = "https://gameofthrones.fandom.com/ru/wiki/"
-for name in names:
-    url = base_url + name
-    parse_biography(url)
\ No newline at end of file
+    crawl(names, parse_biography, OUTPUT_DIR, base_url=args.base_url,
+          max_workers=args.workers, refresh=args.refresh)
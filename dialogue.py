@@ -18,7 +18,13 @@ fast_answer(qa_chain)
 start_dialogue(
     sources=False,         # определяет видимость списка источников, на которые опиралась модель
     len_sources=None,      # количество символов в выводимых фрагментах источников
-    num_attempts=1,        # количество попыток получения ответа, между запросами устоновлен временной делей
-                           # влияет на время получения ответа, рекомендуемое количество -- от 1 до 6
-    all_answers=False      # определяет видимость списка полученных ответов и оценку их
+    num_attempts=1,        # количество попыток получения ответа, запросы к API отправляются параллельно
+                           # с ограничением частоты, рекомендуемое количество -- от 1 до 6
+    all_answers=False,     # определяет видимость списка полученных ответов и оценку их
+    adaptive=False,        # прекращать попытки, как только получен достаточно уверенный ответ
+    multi_query=None,      # "fused" -- перефразировки только для поиска и один вызов LLM по общему контексту,
+                           # "shared" -- все попытки по одному общему контексту, None -- у каждой попытки свой
+    streaming=False,       # печатать ответ по мере генерации; если позже готов более уверенный ответ, он заменяет текущий
+    show_metrics=False,    # вывести при выходе сводку времени работы этапов RAG (см. metrics.py)
+    metadata_filter=None   # искать только в части корпуса, например {'season': 3} или {'hero': 'Джон Сноу'}
 )
\ No newline at end of file
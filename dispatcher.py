@@ -0,0 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import threading
+import copy
+import os
+
+
+# число рабочих потоков по умолчанию: как у ThreadPoolExecutor, задания в основном ждут ответа API
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+
+class QueueFull(Exception):
+    """
+    Очередь пользователя заполнена, новое задание не принято.
+    """
+
+
+class Dispatcher:
+    """
+    Пул рабочих потоков, выполняющий задания пользователей.
+
+    Задания одного пользователя выполняются строго по очереди, в порядке поступления,
+    задания разных пользователей -- параллельно. Число ожидающих заданий одного
+    пользователя ограничено, что защищает пул от перегрузки одним пользователем.
+    """
+
+    def __init__(self, max_workers=DEFAULT_WORKERS, max_pending_per_user=3):
+        """
+        Args:
+            max_workers (int): Число рабочих потоков
+            max_pending_per_user (int): Максимальное число заданий пользователя,
+                ожидающих завершения текущего
+        """
+        self.max_workers = max_workers
+        self.max_pending_per_user = max_pending_per_user
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rag-worker")
+
+        self.lock = threading.Lock()
+        # пользователь -> задания, ожидающие завершения его текущего задания
+        self.queues = {}
+        # задания, переданные в пул и еще не завершенные
+        self.scheduled = 0
+
+    def submit(self, user_id, fn, *args):
+        """
+        Ставит задание пользователя в очередь.
+
+        Args:
+            user_id: Идентификатор пользователя
+            fn: Функция задания
+            *args: Аргументы функции
+
+        Returns:
+            int: Номер задания в очереди (0 -- задание выполняется сразу)
+
+        Raises:
+            QueueFull: Если у пользователя уже слишком много ожидающих заданий
+        """
+        with self.lock:
+            queue = self.queues.get(user_id)
+            if queue is not None:
+                if len(queue) >= self.max_pending_per_user:
+                    raise QueueFull(user_id)
+                queue.append((fn, args))
+                return len(queue)
+
+            self.queues[user_id] = deque()
+            position = max(0, self.scheduled - self.max_workers + 1)
+            self._schedule(user_id, fn, args)
+            return position
+
+    def _schedule(self, user_id, fn, args):
+        # вызывается под self.lock
+        self.scheduled += 1
+        self.executor.submit(self._run, user_id, fn, args)
+
+    def _run(self, user_id, fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f"Ошибка при выполнении задания пользователя {user_id}: {e}")
+        finally:
+            with self.lock:
+                self.scheduled -= 1
+                queue = self.queues[user_id]
+                if queue:
+                    # следующее задание пользователя встает в конец общей очереди пула,
+                    # чтобы не задерживать задания остальных пользователей
+                    self._schedule(user_id, *queue.popleft())
+                else:
+                    del self.queues[user_id]
+
+    def stats(self):
+        """
+        Returns:
+            dict: Число заданий в пуле, число ожидающих заданий и число пользователей с заданиями
+        """
+        with self.lock:
+            return {
+                'scheduled': self.scheduled,
+                'waiting': sum(len(q) for q in self.queues.values()),
+                'users': len(self.queues),
+            }
+
+    def shutdown(self, wait=True):
+        """
+        Останавливает пул рабочих потоков.
+
+        Args:
+            wait (bool): Дождаться завершения заданий, уже переданных в пул
+        """
+        self.executor.shutdown(wait=wait)
+
+
+class UserSessions:
+    """
+    Потокобезопасное хранилище настроек пользователей бота и идентификаторов
+    сообщений, удаляемых после завершения настройки.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.settings = {}
+        self.messages = {}
+
+    def start(self, user_id):
+        """
+        Начинает новую сессию пользователя: сбрасывает его настройки и список сообщений.
+        """
+        with self.lock:
+            self.settings[user_id] = {}
+            self.messages[user_id] = []
+
+    def update(self, user_id, **values):
+        """
+        Обновляет настройки пользователя.
+        """
+        with self.lock:
+            self.settings.setdefault(user_id, {}).update(values)
+
+    def get(self, user_id):
+        """
+        Returns:
+            dict: Копия настроек пользователя или None, если сессия не начата
+        """
+        with self.lock:
+            settings = self.settings.get(user_id)
+            return copy.deepcopy(settings) if settings is not None else None
+
+    def track_message(self, user_id, message_id):
+        """
+        Запоминает сообщение, которое нужно удалить после завершения настройки.
+        """
+        with self.lock:
+            self.messages.setdefault(user_id, []).append(message_id)
+
+    def pop_messages(self, user_id):
+        """
+        Returns:
+            list: Идентификаторы запомненных сообщений пользователя (список очищается)
+        """
+        with self.lock:
+            return self.messages.pop(user_id, [])
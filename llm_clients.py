@@ -0,0 +1,203 @@
+from langchain_core.language_models import FakeListChatModel
+
+import threading
+import asyncio
+import random
+import httpx
+import time
+import os
+
+
+MISTRAL_ENDPOINT = "https://api.mistral.ai/v1"
+
+# коды ответа, при которых запрос к API повторяется с экспоненциальной задержкой
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# ответы локальной модели-заглушки для тестов и бенчмарков без доступа к API
+FAKE_RESPONSES = [
+    "Кто является настоящими родителями Джона Сноу?\n"
+    "Чей сын Джон Сноу на самом деле?\n"
+    "Как зовут отца и мать Джона Сноу?\n"
+    "От кого родился Джон Сноу?\n"
+    "Кто родители Джона Сноу?",
+    "Джон Сноу — сын Рейгара Таргариена и Лианны Старк. Поскольку Эддард Старк "
+    "обещал сестре защитить ребёнка, он выдал Джона за своего бастарда.",
+]
+
+
+def retry_delay(response, attempt, backoff, max_backoff):
+    """
+    Вычисляет задержку перед повтором запроса: заголовок Retry-After,
+    если сервер его прислал, иначе экспоненциальная задержка со случайным разбросом.
+
+    Args:
+        response (httpx.Response): Ответ сервера
+        attempt (int): Номер неудачной попытки (с нуля)
+        backoff (float): Базовая задержка в секундах
+        max_backoff (float): Максимальная задержка в секундах
+
+    Returns:
+        float: Задержка в секундах
+    """
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), max_backoff)
+        except ValueError:
+            pass
+
+    delay = backoff * 2 ** attempt
+    return min(delay + random.uniform(0, delay), max_backoff)
+
+
+class RetryTransport(httpx.BaseTransport):
+    """
+    HTTP-транспорт, повторяющий запросы при ответах 429 и 5xx.
+    """
+
+    def __init__(self, transport, max_retries=3, backoff=0.5, max_backoff=8.0):
+        self.transport = transport
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def handle_request(self, request):
+        for attempt in range(self.max_retries + 1):
+            response = self.transport.handle_request(request)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                return response
+
+            response.close()
+            time.sleep(retry_delay(response, attempt, self.backoff, self.max_backoff))
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncRetryTransport(httpx.AsyncBaseTransport):
+    """
+    Асинхронный HTTP-транспорт, повторяющий запросы при ответах 429 и 5xx.
+    """
+
+    def __init__(self, transport, max_retries=3, backoff=0.5, max_backoff=8.0):
+        self.transport = transport
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    async def handle_async_request(self, request):
+        for attempt in range(self.max_retries + 1):
+            response = await self.transport.handle_async_request(request)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                return response
+
+            await response.aclose()
+            await asyncio.sleep(retry_delay(response, attempt, self.backoff, self.max_backoff))
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def create_http_clients(api_key, timeout=20, max_retries=3, max_connections=20, max_keepalive=10):
+    """
+    Создает синхронный и асинхронный HTTP-клиенты к API Mistral с пулом
+    постоянных соединений (keep-alive) и повтором запросов при 429/5xx.
+
+    Args:
+        api_key (str): API ключ для Mistral
+        timeout (float): Таймаут запроса в секундах
+        max_retries (int): Число повторов при ответах 429/5xx
+        max_connections (int): Максимальное число соединений в пуле
+        max_keepalive (int): Число соединений, удерживаемых открытыми между запросами
+
+    Returns:
+        tuple: (httpx.Client, httpx.AsyncClient)
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        "Authorization": f"Bearer {api_key}",
+    }
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive,
+        keepalive_expiry=60
+    )
+
+    client = httpx.Client(
+        base_url=MISTRAL_ENDPOINT,
+        headers=headers,
+        timeout=timeout,
+        transport=RetryTransport(httpx.HTTPTransport(limits=limits, retries=2), max_retries)
+    )
+    async_client = httpx.AsyncClient(
+        base_url=MISTRAL_ENDPOINT,
+        headers=headers,
+        timeout=timeout,
+        transport=AsyncRetryTransport(httpx.AsyncHTTPTransport(limits=limits, retries=2), max_retries)
+    )
+
+    return client, async_client
+
+
+def create_llm(model_name, backend, timeout=20, max_retries=3):
+    """
+    Создает клиент языковой модели.
+
+    Args:
+        model_name (str): Название модели
+        backend (str): mistral -- API Mistral, fake -- локальная модель-заглушка
+        timeout (float): Таймаут запроса в секундах
+        max_retries (int): Число повторов при ответах 429/5xx
+
+    Returns:
+        BaseChatModel: Клиент языковой модели
+    """
+    if backend == "fake":
+        latency = float(os.environ.get("RAG_FAKE_LLM_LATENCY", 0))
+        return FakeListChatModel(responses=FAKE_RESPONSES, sleep=latency or None)
+
+    if backend != "mistral":
+        raise ValueError(f"Неизвестный backend LLM: {backend}")
+
+    # ключ и клиент Mistral нужны только для реального API, поэтому заглушка работает без них
+    from langchain_mistralai import ChatMistralAI
+    from config import api_key
+
+    client, async_client = create_http_clients(api_key, timeout, max_retries)
+    return ChatMistralAI(
+        mistral_api_key=api_key,
+        model=model_name,
+        timeout=timeout,
+        max_retries=max_retries,
+        client=client,
+        async_client=async_client
+    )
+
+
+_llms = {}
+_llms_lock = threading.Lock()
+
+
+def get_llm(model_name="mistral-large-latest", backend=None, timeout=20, max_retries=3):
+    """
+    Возвращает общий для процесса клиент языковой модели, создавая его при первом
+    обращении. Все вызовы с одинаковыми параметрами используют один клиент
+    и, следовательно, один пул HTTP-соединений.
+
+    Args:
+        model_name (str): Название модели
+        backend (str): mistral или fake (по умолчанию -- переменная окружения RAG_LLM_BACKEND или mistral)
+        timeout (float): Таймаут запроса в секундах
+        max_retries (int): Число повторов при ответах 429/5xx
+
+    Returns:
+        BaseChatModel: Клиент языковой модели
+    """
+    backend = backend or os.environ.get("RAG_LLM_BACKEND", "mistral")
+    key = (backend, model_name, timeout, max_retries)
+
+    with _llms_lock:
+        if key not in _llms:
+            _llms[key] = create_llm(model_name, backend, timeout, max_retries)
+        return _llms[key]
@@ -1,31 +1,64 @@
-from config import api_key
-from langchain_mistralai import ChatMistralAI
-from RAG_pipeline import RAG_pipeline
-
+from RAG_pipeline import get_rag_engine
+from utils import reciprocal_rank_fusion
+from metrics import span, record, print_summary
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict
+from bisect import bisect_right
+import threading
+import json
 import time
-import gc
 import re
 
 
+# максимальное число одновременных обращений к RAG-цепочке для одного вопроса
+MAX_CONCURRENT_REQUESTS = 6
+
+# параметры адаптивного режима: число одновременных попыток, оценка уверенности,
+# достаточная для досрочной остановки, и доля общих слов, при которой ответы считаются сошедшимися
+ADAPTIVE_WORKERS = 2
+ADAPTIVE_SCORE_THRESHOLD = 10.0
+ADAPTIVE_CONVERGENCE = 0.8
+
+# число чанков в общем контексте, собранном из выдач всех перефразировок
+FUSED_CONTEXT_SIZE = 10
+
+
 # функции для формирования списка возможных ответов
 
-def ask_rag(question, qa_chain):
+def ask_rag(question, qa_chain, cache=None):
     """
     Получает ответ на вопрос с помощью RAG системы.
 
     Args:
         question (str): Вопрос пользователя
         qa_chain: Цепочка RAG системы
+        cache (AnswerCache): Кэш ответов (None -- без кэширования)
 
     Returns:
         tuple: (ответ модели, использованные источники)
     """
 
+    if cache is not None:
+        cached, embedding = cache.get(question, 1)
+        if cached is not None:
+            return cached[0]["response"], cached[0]["sources"]
+
     result = qa_chain.invoke({"query": question})
-    return result["result"], result["source_documents"]
+    answer, sources = result["result"], result["source_documents"]
+
+    if cache is not None:
+        cache.put(question, 1, [{
+            "query": question,
+            "response": answer,
+            "sources": sources,
+            "confidence_score": calculate_confidence(answer, sources)
+        }], embedding)
+
+    return answer, sources
 
 
-def get_paraphrased_queries(query, num_attempts, llm):
+def get_paraphrased_queries(query, num_attempts, llm, rate_limiter=None, cache=None):
     """
     Генерирует перефразированные версии исходного запроса.
 
@@ -33,6 +66,8 @@ def get_paraphrased_queries(query, num_attempts, llm):
         query (str): Исходный запрос
         num_attempts (int): Количество требуемых перефразировок
         llm: Языковая модель для перефразирования
+        rate_limiter (TokenBucket): Ограничитель частоты обращений к API
+        cache (ParaphraseCache): Кэш перефразировок (None -- без кэширования)
 
     Returns:
         list: Список перефразированных запросов
@@ -43,78 +78,307 @@ def get_paraphrased_queries(query, num_attempts, llm):
     if num_attempts > 6:
         num_attempts = 6
 
+    model = getattr(llm, "model", type(llm).__name__)
+    if cache is not None:
+        cached = cache.get(query, num_attempts, model)
+        if cached is not None:
+            return cached
+
     paraphrase_prompt = f"Перефразируй следующий вопрос {num_attempts} разными способами, \
                         сохраняя смысл. Напиши только перефразированные версии, \
                         каждую с новой строки: {query}"
     
-    paraphrased = llm.invoke(paraphrase_prompt).content
-    time.sleep(1)
+    if rate_limiter is not None:
+        rate_limiter.acquire()
+    with span("paraphrase", num_attempts=num_attempts):
+        paraphrased = llm.invoke(paraphrase_prompt).content
 
     paraphrased_queries = [query] + [
         q.strip() for q in paraphrased.split('\n') 
         if q.strip()
     ][:num_attempts-1]
+
+    if cache is not None:
+        cache.put(query, num_attempts, model, paraphrased_queries)
     
     return paraphrased_queries
 
 
-def get_multiple_responses(query, qa_chain, num_attempts):
+def fuse_retrieved(retrieved, size=FUSED_CONTEXT_SIZE):
+    """
+    Объединяет выдачи всех перефразировок в один контекст: чанки дедуплицируются
+    по chunk_id и ранжируются reciprocal rank fusion.
+
+    Args:
+        retrieved (list): Списки найденных документов для каждой перефразировки
+        size (int): Максимальное число чанков в контексте
+
+    Returns:
+        list: Общий для всех перефразировок контекст
+    """
+    return reciprocal_rank_fusion(retrieved)[:size]
+
+
+def get_adaptive_responses(queries, retrieved, answer_fn, max_workers=ADAPTIVE_WORKERS,
+                           score_threshold=ADAPTIVE_SCORE_THRESHOLD, convergence=ADAPTIVE_CONVERGENCE):
+    """
+    Получает ответы на перефразировки по мере их готовности и останавливается,
+    как только оценка уверенности очередного ответа достигает порога или
+    ответ совпадает по словам с одним из уже полученных. Попытки, еще стоящие
+    в очереди, отменяются, а результаты уже выполняющихся игнорируются.
+
+    Args:
+        queries (list): Перефразированные запросы
+        retrieved (list): Найденные документы для каждого запроса
+        answer_fn: Функция (номер попытки, запрос, документы) -> (ответ модели, число токенов промпта)
+        max_workers (int): Число одновременно выполняемых попыток
+        score_threshold (float): Оценка уверенности, достаточная для остановки
+        convergence (float): Доля общих слов (Jaccard), при которой ответы считаются сошедшимися
+
+    Returns:
+        list: Список словарей с полученными ответами и их метриками (в порядке перефразировок)
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {
+        executor.submit(answer_fn, i, q, sources): i
+        for i, (q, sources) in enumerate(zip(queries, retrieved))
+    }
+    results = {}
+    word_sets = []
+
+    try:
+        for future in as_completed(futures):
+            i = futures[future]
+            answer, prompt_tokens = future.result()
+            with span("score", answers=1):
+                score = calculate_confidence(answer, retrieved[i])
+            results[i] = {
+                "query": queries[i],
+                "response": answer,
+                "sources": retrieved[i],
+                "confidence_score": score,
+                "prompt_tokens": prompt_tokens
+            }
+
+            words = set(answer.lower().split())
+            converged = any(
+                len(words & other) / len(words | other) >= convergence
+                for other in word_sets if words | other
+            )
+            word_sets.append(words)
+
+            if score >= score_threshold or converged:
+                break
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return [results[i] for i in sorted(results)]
+
+
+def get_multiple_responses(query, engine, num_attempts, max_workers=MAX_CONCURRENT_REQUESTS, use_cache=True,
+                           adaptive=False, score_threshold=ADAPTIVE_SCORE_THRESHOLD, multi_query=None,
+                           stream=None, metadata_filter=None):
     """
     Получает несколько ответов на перефразированные версии запроса.
+    Поиск документов для всех перефразировок выполняется одним батчевым проходом,
+    затем запросы на генерацию отправляются одновременно, частота обращений
+    к API ограничивается общим для движка token bucket.
 
     Args:
         query (str): Исходный запрос
-        qa_chain: Цепочка вопрос-ответ RAG системы
+        engine (RAGEngine): Общий RAG-движок
         num_attempts (int): Количество попыток получения ответа
+        max_workers (int): Максимальное число одновременных обращений (1 -- последовательный режим)
+        use_cache (bool): Искать ответ в кэше движка и сохранять туда новый
+        adaptive (bool): Адаптивный режим: остановиться, как только получен достаточно
+            уверенный ответ (см. get_adaptive_responses)
+        score_threshold (float): Оценка уверенности, достаточная для остановки в адаптивном режиме
+        multi_query (str): Режим общего контекста: None -- у каждой перефразировки свой контекст,
+            "shared" -- все перефразировки отвечают по общему дедуплицированному контексту,
+            "fused" -- перефразировки используются только для поиска, ответ генерируется
+            один раз на исходный вопрос по общему контексту
+        stream (AnswerStream): Получатель потоковой выдачи ответов (None -- без потоковой выдачи)
+        metadata_filter (dict): Искать источники только в документах с такими метаданными,
+            например {'season': 3} или {'hero': 'Джон Сноу'}
 
     Returns:
-        list: Список словарей с ответами и их метриками
+        list: Список словарей с ответами и их метриками (в порядке перефразировок)
     """
 
-    llm = ChatMistralAI(
-        mistral_api_key=api_key,
-        model="mistral-large-latest",
-        timeout=20
+    variant = ("a" if adaptive else "") + (multi_query or "")
+    if metadata_filter:
+        variant += json.dumps(metadata_filter, ensure_ascii=False, sort_keys=True)
+    cache = engine.answer_cache if use_cache else None
+    if cache is not None:
+        with span("cache.lookup"):
+            cached, embedding = cache.get(query, num_attempts, variant)
+        record("cache.hit", int(cached is not None))
+        if cached is not None:
+            return cached
+
+    paraphrased_queries = get_paraphrased_queries(
+        query, num_attempts, engine.llm, engine.rate_limiter,
+        engine.paraphrase_cache if use_cache else None
     )
-    
-    paraphrased_queries = get_paraphrased_queries(query, num_attempts, llm)
-    responses = []
 
-    for q in paraphrased_queries:
-        answer, sources = ask_rag(q, qa_chain)
-        responses.append({
-            "query": q,
-            "response": answer,
-            "sources": sources,
-            "confidence_score": calculate_confidence(answer, sources)
-        })
-        time.sleep(1)
-        gc.collect()
+    retrieved = engine.retrieve_batch(paraphrased_queries, metadata_filter)
+
+    if multi_query is not None:
+        if multi_query not in ("shared", "fused"):
+            raise ValueError(f"Неизвестный режим multi_query: {multi_query}")
+
+        context = fuse_retrieved(retrieved)
+        if multi_query == "fused":
+            paraphrased_queries = [query]
+        retrieved = [context] * len(paraphrased_queries)
+
+    def answer_query(i, q, sources):
+        engine.rate_limiter.acquire()
+        if stream is None:
+            return engine.generate(q, sources)
+
+        answer, prompt_tokens = engine.generate(q, sources, lambda chunk: stream.token(i, chunk))
+        stream.finish(i, calculate_confidence(answer, sources))
+        return answer, prompt_tokens
+
+    if adaptive:
+        workers = max(1, min(max_workers, ADAPTIVE_WORKERS))
+        responses = get_adaptive_responses(
+            paraphrased_queries, retrieved, answer_query, workers, score_threshold
+        )
+    else:
+        workers = max(1, min(max_workers, len(paraphrased_queries)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            generated = list(executor.map(answer_query, range(len(retrieved)), paraphrased_queries, retrieved))
+        answers = [answer for answer, _ in generated]
+
+        # все ответы оцениваются одним пакетным проходом
+        with span("score", answers=len(answers)):
+            scores = score_answers(answers, retrieved)
+        responses = [
+            {
+                "query": q,
+                "response": answer,
+                "sources": sources,
+                "confidence_score": score,
+                "prompt_tokens": prompt_tokens
+            }
+            for q, (answer, prompt_tokens), sources, score in zip(paraphrased_queries, generated, retrieved, scores)
+        ]
+
+    if cache is not None:
+        cache.put(query, num_attempts, responses, embedding, variant)
     
     return responses
 
 
 # функции для оценки качества ответа
 
-def calculate_source_relevance(answer_lower, sources):
+# признаки фактической информации в ответе
+FACT_PATTERNS = [
+    re.compile(r'\d+'),                        # Числа
+    re.compile(r'\d{1,2}:\d{2}'),              # Время
+    re.compile(r'\d{1,2}\s+\w+\s+\d{4}'),      # Даты
+    re.compile(r'[А-Я][а-я]+\s+[А-Я][а-я]+'),  # Имена собственные
+]
+
+# Бонусы за структурированность
+STRUCTURAL_INDICATORS = [
+    "во-первых", "первое", "поскольку", "так как", "потому что",
+    "суммируя", "подводя итог", "в итоге"
+]
+
+# Неуверенные ответы
+UNCERTAINTY_PHRASES = [
+    "возможно", "вероятно", "предположительно",
+    "может быть", "вроде", "вроде бы",
+    "вроде как", "кажется", "кажись",
+    "будто", "как будто", "наверно",
+    "наверное", "видимо", "по-видимому",
+    "похоже", "должно быть",
+    "трудно сказать", "сложно утверждать",
+    "я не уверен", "это спорный вопрос",
+    "нельзя сказать точно", "под вопросом",
+    "требует уточнения", "нет точных данных",
+    "недостаточно информации", "не могу точно сказать"
+]
+
+# Прямые указания на незнание
+IGNORANCE_PHRASES = [
+    "не знаю", "не указан", "не могу сказать",
+    "точно не известно", "нет информации", "нет данных",
+    "не совсем ясно", "затрудняюсь ответить",
+    "информация отсутствует", "не располагаю информацией",
+]
+
+ALL_PHRASES = set(STRUCTURAL_INDICATORS + UNCERTAINTY_PHRASES + IGNORANCE_PHRASES)
+
+# Все фразы собраны в одно регулярное выражение: lookahead находит в каждой позиции
+# самую длинную из начинающихся там фраз, а PHRASE_CLOSURE добавляет вложенные в нее
+# фразы (например, "вроде" внутри "вроде бы"). Это дает ровно то же множество фраз,
+# что и отдельные проверки `phrase in answer_lower`, но за один проход по тексту.
+PHRASE_PATTERN = re.compile(
+    '(?=(' + '|'.join(re.escape(p) for p in sorted(ALL_PHRASES, key=len, reverse=True)) + '))'
+)
+PHRASE_CLOSURE = {q: frozenset(p for p in ALL_PHRASES if p in q) for q in ALL_PHRASES}
+
+# Разделитель ответов при пакетной оценке: не входит ни в одну фразу и ни в один шаблон фактов
+ANSWER_SEPARATOR = '\x00'
+
+SOURCE_WORDS_CACHE_SIZE = 8192
+_source_words = OrderedDict()
+_source_words_lock = threading.Lock()
+
+
+def get_source_words(source):
+    """
+    Возвращает множество слов источника в нижнем регистре.
+    Множества кэшируются по chunk_id документа, поэтому каждый чанк
+    разбивается на слова один раз.
+
+    Args:
+        source (Document): Документ-источник
+
+    Returns:
+        frozenset: Множество слов источника
+    """
+    key = source.metadata.get('chunk_id', source.page_content)
+
+    with _source_words_lock:
+        words = _source_words.get(key)
+        if words is not None:
+            _source_words.move_to_end(key)
+            return words
+
+    words = frozenset(source.page_content.lower().split())
+
+    with _source_words_lock:
+        _source_words[key] = words
+        if len(_source_words) > SOURCE_WORDS_CACHE_SIZE:
+            _source_words.popitem(last=False)
+
+    return words
+
+
+def calculate_source_relevance(answer_lower, sources, answer_words=None):
     """
     Вычисляет релевантность ответа относительно источников.
 
     Args:
         answer_lower (str): Ответ в нижнем регистре
         sources (list): Список источников
+        answer_words (set): Уже выделенные слова ответа (чтобы не разбивать ответ повторно)
 
     Returns:
         float: Оценка релевантности
     """
 
     source_relevance = 0
-    answer_words = set(answer_lower.split())
+    if answer_words is None:
+        answer_words = set(answer_lower.split())
 
     for source in sources:
-        source_text = source.page_content.lower()
-        source_words = set(source_text.split())
-        overlap = len(answer_words.intersection(source_words))
+        overlap = len(answer_words.intersection(get_source_words(source)))
         source_relevance += overlap / len(answer_words) if answer_words else 0
 
     return source_relevance / len(sources) if sources else 0
@@ -131,98 +395,143 @@ def check_facts_presence(answer):
         int: Количество найденных фактов
     """
 
-    fact_indicators = [
-        r'\d+',                        # Числа
-        r'\d{1,2}:\d{2}',              # Время
-        r'\d{1,2}\s+\w+\s+\d{4}',      # Даты
-        r'[А-Я][а-я]+\s+[А-Я][а-я]+',  # Имена собственные
-    ]
-
     facts_score = 0
-    for pattern in fact_indicators:
-        facts_count = len(re.findall(pattern, answer))
-        facts_score += facts_count
+    for pattern in FACT_PATTERNS:
+        facts_score += len(pattern.findall(answer))
     
     return facts_score
 
 
-def calculate_confidence(answer, sources):
+def locate_matches(pattern, text, offsets):
     """
-    Вычисляет оценку уверенности для ответа на основе различных факторов.
+    Находит совпадения шаблона в склеенном тексте нескольких ответов
+    и распределяет их по ответам.
+
+    Args:
+        pattern (re.Pattern): Скомпилированный шаблон
+        text (str): Ответы, склеенные через ANSWER_SEPARATOR
+        offsets (list): Позиции начала каждого ответа в text
+
+    Yields:
+        tuple: (номер ответа, объект совпадения)
+    """
+    for match in pattern.finditer(text):
+        yield bisect_right(offsets, match.start()) - 1, match
+
+
+def separator_offsets(texts):
+    """
+    Returns:
+        list: Позиции начала каждого текста после склейки через ANSWER_SEPARATOR
+    """
+    offsets, position = [], 0
+    for text in texts:
+        offsets.append(position)
+        position += len(text) + len(ANSWER_SEPARATOR)
+    return offsets
+
+
+def score_answers(answers, sources_list):
+    """
+    Вычисляет оценки уверенности сразу для нескольких ответов.
+    Все ответы склеиваются и проверяются каждым шаблоном за один проход,
+    каждый ответ разбивается на слова один раз.
+
+    Args:
+        answers (list): Ответы модели
+        sources_list (list): Списки источников для каждого ответа
+
+    Returns:
+        list: Оценки уверенности в порядке ответов
+    """
+    answers = list(answers)
+    answers_lower = [answer.lower() for answer in answers]
+
+    facts = [0] * len(answers)
+    offsets = separator_offsets(answers)
+    joined = ANSWER_SEPARATOR.join(answers)
+    for pattern in FACT_PATTERNS:
+        for i, _ in locate_matches(pattern, joined, offsets):
+            facts[i] += 1
+
+    phrases = [set() for _ in answers]
+    offsets_lower = separator_offsets(answers_lower)
+    joined_lower = ANSWER_SEPARATOR.join(answers_lower)
+    for i, match in locate_matches(PHRASE_PATTERN, joined_lower, offsets_lower):
+        phrases[i].update(PHRASE_CLOSURE[match.group(1)])
+
+    return [
+        combine_score(answer, answer_lower, sources, facts_count, found)
+        for answer, answer_lower, sources, facts_count, found
+        in zip(answers, answers_lower, sources_list, facts, phrases)
+    ]
+
+
+def combine_score(answer, answer_lower, sources, facts_count, found_phrases):
+    """
+    Собирает итоговую оценку уверенности ответа из заранее найденных признаков.
 
     Args:
         answer (str): Ответ модели
+        answer_lower (str): Ответ в нижнем регистре
         sources (list): Использованные источники
+        facts_count (int): Количество найденных фактов
+        found_phrases (set): Найденные в ответе индикаторы и штрафные фразы
 
     Returns:
         float: Оценка уверенности
     """
     score = 0
-    answer_lower = answer.lower()
+    words = answer_lower.split()
+    words_count = len(words)
     
     # Базовая оценка на основе длины
-    score += len(answer.split()) * 0.05
+    score += words_count * 0.05
     
     # Оценка согласованности с источниками
-    score += calculate_source_relevance(answer_lower, sources) * 3.0
+    score += calculate_source_relevance(answer_lower, sources, set(words)) * 3.0
 
     # Бонус за факты
-    score += check_facts_presence(answer)
+    score += facts_count
     
     # Бонусы за структурированность
-    structural_indicators = ["во-первых", "первое", "поскольку", "так как", "потому что", 
-                            "суммируя", "подводя итог", "в итоге"]
-    
-    for indicator in structural_indicators:
-        if indicator in answer_lower:
-            score += 2
-            break
+    if any(indicator in found_phrases for indicator in STRUCTURAL_INDICATORS):
+        score += 2
     
     if ":" in answer:
         score += 1
-    if len(answer.split('.')) > 2:
+    if answer.count('.') >= 2:
         score += 1
     
     # Корректировка за длину
-    words_count = len(answer.split())
     if words_count < 8 or words_count > 100:
         score *= 0.8
 
     # Штрафы за незнание и/или неуверенность
-
-    # Неуверенные ответы
-    uncertainty_phrases = [
-        "возможно", "вероятно", "предположительно",
-        "может быть", "вроде", "вроде бы",
-        "вроде как", "кажется", "кажись",
-        "будто", "как будто", "наверно",
-        "наверное", "видимо", "по-видимому",
-        "похоже", "должно быть",
-        "трудно сказать", "сложно утверждать",
-        "я не уверен", "это спорный вопрос",
-        "нельзя сказать точно", "под вопросом",
-        "требует уточнения", "нет точных данных",
-        "недостаточно информации", "не могу точно сказать"
-    ]
-    
-    # Прямые указания на незнание
-    ignorance_phrases = [
-        "не знаю", "не указан", "не могу сказать",
-        "точно не известно", "нет информации", "нет данных",
-        "не совсем ясно", "затрудняюсь ответить",
-        "информация отсутствует", "не располагаю информацией",
-    ]
-    
-    for phrase in uncertainty_phrases:
-        if phrase in answer_lower:
+    for phrase in UNCERTAINTY_PHRASES:
+        if phrase in found_phrases:
             score *= 0.7
-    for phrase in ignorance_phrases:
-        if phrase in answer_lower:
+    for phrase in IGNORANCE_PHRASES:
+        if phrase in found_phrases:
             score *= 0.2
     
     return score
 
 
+def calculate_confidence(answer, sources):
+    """
+    Вычисляет оценку уверенности для ответа на основе различных факторов.
+
+    Args:
+        answer (str): Ответ модели
+        sources (list): Использованные источники
+
+    Returns:
+        float: Оценка уверенности
+    """
+    return score_answers([answer], [sources])[0]
+
+
 def select_best_response(responses):
     """
     Выбирает лучший ответ на основе оценки уверенности.
@@ -239,6 +548,100 @@ def select_best_response(responses):
 
 # функции ведения диалога с пользователем
 
+class AnswerStream:
+    """
+    Потоковая выдача ответа пользователю во время генерации.
+
+    Пока ни одна попытка не завершена, показывается ответ попытки, первой начавшей
+    выдавать токены. Когда попытки завершаются, показывается завершенный ответ
+    с лучшей оценкой уверенности. Методы token и finish вызываются из рабочих потоков;
+    после close они ничего не делают, поэтому попытки, продолжающие работу после
+    досрочной остановки адаптивного режима, не перезаписывают окончательный ответ.
+    """
+
+    def __init__(self, render, interval=0.0):
+        """
+        Args:
+            render: Функция (текст ответа, флаг окончательного ответа), показывающая ответ
+            interval (float): Минимальный интервал между обновлениями незавершенного ответа в секундах
+        """
+        self.render = render
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.texts = {}
+        self.leader = None
+        self.best_score = None
+        self.last_render = 0.0
+        self.closed = False
+
+    def _show(self, force=False):
+        # вызывается под self.lock
+        now = time.monotonic()
+        if force or now - self.last_render >= self.interval:
+            self.last_render = now
+            self.render(self.texts[self.leader], False)
+
+    def token(self, attempt, chunk):
+        """
+        Принимает очередной фрагмент ответа попытки attempt.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.texts[attempt] = self.texts.get(attempt, "") + chunk
+            if self.leader is None:
+                self.leader = attempt
+            if attempt == self.leader:
+                self._show()
+
+    def finish(self, attempt, score):
+        """
+        Отмечает завершение попытки attempt с оценкой уверенности score.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.texts.setdefault(attempt, "")
+            if self.best_score is not None and score <= self.best_score:
+                return
+            self.best_score = score
+            self.leader = attempt
+            self._show(force=True)
+
+    def close(self, answer):
+        """
+        Показывает окончательный ответ.
+
+        Args:
+            answer (str): Лучший ответ
+        """
+        with self.lock:
+            self.closed = True
+            self.render(answer, True)
+
+
+def console_renderer():
+    """
+    Создает функцию вывода потокового ответа в консоль: новые фрагменты
+    дописываются, а при смене показываемого ответа он печатается заново.
+
+    Returns:
+        function: Функция (текст ответа, флаг окончательного ответа) для AnswerStream
+    """
+    printed = [""]
+
+    def render(text, final):
+        if text.startswith(printed[0]):
+            print(text[len(printed[0]):], end="", flush=True)
+        else:
+            print(f"\n\n[Найден более уверенный ответ]\nОтвет: {text}", end="", flush=True)
+        printed[0] = text
+        if final:
+            print("\n")
+
+    return render
+
+
 def print_sources(sources, len_sources):
     """
     Выводит использованные источники.
@@ -266,10 +669,13 @@ def print_all_responses(responses, best_answer):
         print(f"Перефразированный вопрос: {resp['query']}")
         print(f"Ответ: {resp['response']}")
         print(f"Оценка уверенности: {resp['confidence_score']:.2f}")
+        if "prompt_tokens" in resp:
+            print(f"Токенов в промпте: {resp['prompt_tokens']}")
     print(f"\nЛучший ответ: {best_answer}\n")
 
 
-def start_dialogue(sources=False, len_sources=None, num_attempts=1, all_answers=False):
+def start_dialogue(sources=False, len_sources=None, num_attempts=1, all_answers=False, adaptive=False,
+                   multi_query=None, streaming=False, show_metrics=False, metadata_filter=None):
     """
     Запускает диалоговый интерфейс RAG системы.
 
@@ -278,9 +684,15 @@ def start_dialogue(sources=False, len_sources=None, num_attempts=1, all_answers=
         len_sources (int): Длина выводимого фрагмента источника
         num_attempts (int): Количество попыток получения ответа
         all_answers (bool): Флаг вывода всех полученных ответов
+        adaptive (bool): Прекращать попытки, как только получен достаточно уверенный ответ
+        multi_query (str): Режим общего контекста перефразировок: None, "shared" или "fused"
+        streaming (bool): Печатать ответ по мере генерации
+        show_metrics (bool): Вывести при выходе сводку времени работы этапов (см. metrics.py)
+        metadata_filter (dict): Искать источники только в сериях или биографиях с такими метаданными,
+            например {'season': 3} или {'hero': 'Джон Сноу'}
     """
 
-    qa_chain = RAG_pipeline()
+    engine = get_rag_engine()
     print(f"\nRAG-система готова. Введите Ваш вопрос. \
           \nДля выхода введите 'выход'\n")
 
@@ -288,36 +700,53 @@ def start_dialogue(sources=False, len_sources=None, num_attempts=1, all_answers=
 
         user_input = input("Ваш вопрос: ")
         if user_input.lower() == 'выход':
+            stats = engine.answer_cache.stats()
+            print(f"Кэш ответов: попаданий {stats['exact_hits'] + stats['semantic_hits']}, "
+                  f"промахов {stats['misses']} (доля попаданий {stats['hit_rate']:.0%})")
+            if show_metrics:
+                print_summary()
             break
 
         start_time = time.time()
 
-        responses = get_multiple_responses(user_input, qa_chain, num_attempts)
+        stream = None
+        if streaming:
+            print("Ответ: ", end="", flush=True)
+            stream = AnswerStream(console_renderer())
+
+        responses = get_multiple_responses(
+            user_input, engine, num_attempts, adaptive=adaptive, multi_query=multi_query, stream=stream,
+            metadata_filter=metadata_filter
+        )
         best_answer, best_sources = select_best_response(responses)
 
+        if stream is not None:
+            stream.close(best_answer)
+
         if all_answers:
             print_all_responses(responses, best_answer)
-        else:
+        elif stream is None:
             print(f"Ответ: {best_answer}\n")
         
         if sources:
             print_sources(best_sources, len_sources)
 
-        end_time = time.time()
-        # print(f"Время ответа: {round(end_time - start_time, 3)}\n")
+        record("answer.total", time.time() - start_time, unit="s", num_attempts=num_attempts)
 
 def fast_answer(qa_chain=None):
     """
     Отвечает на один вопрос с помощью RAG системы
 
     Args:
-        qa_chain: Цепочка RAG системы 
+        qa_chain: Цепочка RAG системы (по умолчанию -- цепочка общего движка)
     """
 
+    cache = None
     if qa_chain == None:
-        qa_chain = RAG_pipeline()
+        engine = get_rag_engine()
+        qa_chain, cache = engine.qa_chain, engine.answer_cache
 
     print(f"\nRAG-система готова. Введите Ваш вопрос.\n")
     question = input("Ваш вопрос: ")
-    answer, _ = ask_rag(question, qa_chain)
+    answer, _ = ask_rag(question, qa_chain, cache)
     print(f"Ответ: {answer}\n")
\ No newline at end of file
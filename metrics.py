@@ -0,0 +1,127 @@
+from contextlib import contextmanager
+from collections import defaultdict, deque
+import threading
+import json
+import time
+import os
+
+
+# файл JSON-lines, в который пишутся все замеры (переменная окружения RAG_METRICS_PATH, None -- не писать)
+METRICS_PATH = os.environ.get("RAG_METRICS_PATH")
+
+# сколько последних значений каждой метрики хранится для сводки
+HISTORY_SIZE = 10000
+
+_lock = threading.Lock()
+_values = defaultdict(lambda: deque(maxlen=HISTORY_SIZE))
+_units = {}
+_sink = None
+
+
+def _write(event):
+    """
+    Дописывает событие в файл METRICS_PATH (вызывается под _lock).
+    """
+    global _sink
+    if METRICS_PATH is None:
+        return
+    if _sink is None:
+        _sink = open(METRICS_PATH, 'a', encoding='utf-8', buffering=1)
+    _sink.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+
+def record(name, value, unit="", **fields):
+    """
+    Записывает значение метрики (например, число найденных чанков или размер промпта).
+
+    Args:
+        name (str): Название метрики
+        value (float): Значение
+        unit (str): Единица измерения (для сводки)
+        **fields: Дополнительные поля события в журнале
+    """
+    with _lock:
+        _values[name].append(value)
+        _units[name] = unit
+        _write({'ts': time.time(), 'metric': name, 'value': value, **fields})
+
+
+@contextmanager
+def span(name, **fields):
+    """
+    Замеряет время выполнения блока кода и записывает его как метрику name (в секундах).
+
+    Args:
+        name (str): Название этапа, например "retrieve.faiss"
+        **fields: Дополнительные поля события в журнале (число запросов, режим и т.п.)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, unit="s", **fields)
+
+
+def percentile(values, q):
+    """
+    Перцентиль отсортированного списка значений (метод ближайшего ранга).
+
+    Args:
+        values (list): Отсортированные значения
+        q (float): Перцентиль от 0 до 100
+
+    Returns:
+        float: Значение перцентиля
+    """
+    rank = max(0, -(-len(values) * q // 100) - 1)
+    return values[int(rank)]
+
+
+def summary():
+    """
+    Сводка по всем метрикам, накопленным в процессе.
+
+    Returns:
+        dict: Название метрики -> число замеров, среднее, p50, p95, максимум и единица измерения
+    """
+    with _lock:
+        snapshot = {name: (sorted(values), _units[name]) for name, values in _values.items()}
+
+    result = {}
+    for name, (values, unit) in sorted(snapshot.items()):
+        if not values:
+            continue
+        result[name] = {
+            'count': len(values),
+            'mean': sum(values) / len(values),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'max': values[-1],
+            'unit': unit,
+        }
+    return result
+
+
+def print_summary():
+    """
+    Выводит сводку по метрикам в виде таблицы.
+    """
+    stats = summary()
+    if not stats:
+        print("Замеров нет.")
+        return
+
+    width = max(len(name) for name in stats)
+    print(f"{'метрика':<{width}} {'n':>6} {'среднее':>10} {'p50':>10} {'p95':>10} {'макс':>10}")
+    for name, s in stats.items():
+        print(f"{name:<{width}} {s['count']:>6} {s['mean']:>10.3f} {s['p50']:>10.3f} "
+              f"{s['p95']:>10.3f} {s['max']:>10.3f} {s['unit']}")
+
+
+def reset():
+    """
+    Очищает накопленные значения метрик.
+    """
+    with _lock:
+        _values.clear()
+        _units.clear()
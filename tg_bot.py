@@ -1,14 +1,27 @@
 ﻿import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
-from main import get_multiple_responses, select_best_response
-from RAG_pipeline import RAG_pipeline
+from main import get_multiple_responses, select_best_response, AnswerStream
+from RAG_pipeline import get_rag_engine
+from dispatcher import Dispatcher, UserSessions, QueueFull, DEFAULT_WORKERS
+from metrics import span, record
 from config import bot_token
+import threading
+import time
+import os
 
 TOKEN = bot_token
 bot = telebot.TeleBot(TOKEN)
 
-user_settings = {}
-setup_messages = {}
+# ответы на вопросы готовятся в отдельном пуле потоков, обработчики сообщений только ставят задания в очередь
+dispatcher = Dispatcher(
+    max_workers=int(os.environ.get("RAG_BOT_WORKERS", DEFAULT_WORKERS)),
+    max_pending_per_user=int(os.environ.get("RAG_BOT_QUEUE_SIZE", 3))
+)
+sessions = UserSessions()
+
+# ответ показывается по мере генерации, сообщение редактируется не чаще раза в STREAM_INTERVAL секунд
+STREAMING = os.environ.get("RAG_BOT_STREAMING", "1") != "0"
+STREAM_INTERVAL = 1.0
 
 def create_yes_no_keyboard():
     keyboard = InlineKeyboardMarkup()
@@ -17,7 +30,7 @@ def create_yes_no_keyboard():
     return keyboard
 
 def show_final_settings(chat_id, user_id):
-    settings = user_settings[user_id]
+    settings = sessions.get(user_id)
     summary = "📋 Ваши настройки:\n\n"
     
     summary += "🔍 Показывать источники: "
@@ -39,90 +52,71 @@ def show_final_settings(chat_id, user_id):
 @bot.message_handler(commands=['start'])
 def start(message):
     user_id = message.from_user.id
-    setup_messages[user_id] = []
+    sessions.start(user_id)
     init_msg = bot.reply_to(message, 'Инициализация RAG-системы...')
-    setup_messages[user_id].append(init_msg.message_id)
+    sessions.track_message(user_id, init_msg.message_id)
     
-    user_settings[user_id] = {'qa_chain': RAG_pipeline()}
+    # RAG-движок общий для всех пользователей и создается только при первом /start
+    get_rag_engine()
     bot.reply_to(message, 'Привет! Я готов отвечать на твои вопросы по сериалу "Игра престолов". Для начала нужно провести настройку бота.')
     ask_sources(message)
 
 
 def ask_sources(message):
     msg = bot.send_message(message.chat.id, "Выводить ли список фрагментов лора, используемых для формирования ответа?", reply_markup=create_yes_no_keyboard())
-    setup_messages[message.from_user.id].append(msg.message_id)
+    sessions.track_message(message.from_user.id, msg.message_id)
 
 
 @bot.callback_query_handler(func=lambda call: call.data in ["yes", "no"])
 def callback_sources(call):
     user_id = call.from_user.id
-    if user_id not in user_settings:
-        user_settings[user_id] = {}
-    if user_id not in setup_messages:
-        setup_messages[user_id] = []
-        
-    user_settings[user_id]['show_sources'] = call.data == "yes"
+    sessions.update(user_id, show_sources=call.data == "yes")
     bot.answer_callback_query(call.id)
     
     if call.data == "yes":
         msg = bot.send_message(call.message.chat.id, "Введите длину фрагмента источников (число символов):")
-        setup_messages[user_id].append(msg.message_id)
+        sessions.track_message(user_id, msg.message_id)
         bot.register_next_step_handler(call.message, set_source_length)
     else:
         ask_attempts(call.message)
 
 def ask_attempts(message):
     user_id = message.from_user.id
-    if user_id not in setup_messages:
-        setup_messages[user_id] = []
-        
-    msg = bot.send_message(message.chat.id, "Сколько попыток обращений к LLM использовать? Введите число от 1 до 6. Большее значение повышает качество ответа, но заметно увеличивает время его ожидания.")
-    setup_messages[user_id].append(msg.message_id)
-    bot.register_next_step_handler(message, set_attempts)
-
-def ask_attempts(message):
-    user_id = message.from_user.id
-    if user_id not in setup_messages:
-        setup_messages[user_id] = []
-        
     msg = bot.send_message(message.chat.id, "Сколько попыток обращений к LLM использовать? Введите число от 1 до 6. Большее значение повышает качество ответа, но заметно увеличивает время его ожидания.")
-    setup_messages[user_id].append(msg.message_id)
-    setup_messages[user_id].append(message.message_id)  # Добавляем ID исходного сообщения
+    sessions.track_message(user_id, msg.message_id)
+    sessions.track_message(user_id, message.message_id)  # Добавляем ID исходного сообщения
     bot.register_next_step_handler(message, set_attempts)
 
 def set_attempts(message):
     user_id = message.from_user.id
-    if user_id not in setup_messages:
-        setup_messages[user_id] = []
-    
-    setup_messages[user_id].append(message.message_id)  # Добавляем ID ответа пользователя
+    sessions.track_message(user_id, message.message_id)  # Добавляем ID ответа пользователя
         
     try:
         attempts = int(message.text)
         if 1 <= attempts <= 6:
-            user_settings[user_id]['num_attempts'] = attempts
+            sessions.update(user_id, num_attempts=attempts)
             ask_all_answers(message)
         else:
             msg = bot.reply_to(message, "Пожалуйста, введите число от 1 до 6.")
-            setup_messages[user_id].append(msg.message_id)
+            sessions.track_message(user_id, msg.message_id)
             bot.register_next_step_handler(message, set_attempts)
     except ValueError:
         msg = bot.reply_to(message, "Пожалуйста, введите число.")
-        setup_messages[user_id].append(msg.message_id)
+        sessions.track_message(user_id, msg.message_id)
         bot.register_next_step_handler(message, set_attempts)
 
 
 
 def set_source_length(message):
     user_id = message.from_user.id
-    setup_messages[user_id].append(message.message_id)
+    sessions.track_message(user_id, message.message_id)
     try:
         length = int(message.text)
-        user_settings[user_id]['source_length'] = length
+        sessions.update(user_id, source_length=length)
         ask_attempts(message)
     except ValueError:
         msg = bot.reply_to(message, "Пожалуйста, введите число.")
-        setup_messages[user_id].append(msg.message_id)
+        sessions.track_message(user_id, msg.message_id)
         bot.register_next_step_handler(message, set_source_length)
 
 
@@ -131,23 +125,21 @@ def ask_all_answers(message):
     keyboard.row(InlineKeyboardButton("Лучший ответ", callback_data="best"),
                  InlineKeyboardButton("Все ответы", callback_data="all"))
     msg = bot.send_message(message.chat.id, "Выводить все полученные ответы или только лучший?", reply_markup=keyboard)
-    setup_messages[message.from_user.id].append(msg.message_id)
+    sessions.track_message(message.from_user.id, msg.message_id)
 
 @bot.callback_query_handler(func=lambda call: call.data in ["best", "all"])
 def callback_answers(call):
     user_id = call.from_user.id
-    user_settings[user_id]['all_answers'] = call.data == "all"
+    sessions.update(user_id, all_answers=call.data == "all")
     bot.answer_callback_query(call.id)
     
     # Удаляем все сообщения настройки
-    for msg_id in setup_messages[user_id]:
+    for msg_id in sessions.pop_messages(user_id):
         try:
             bot.delete_message(call.message.chat.id, msg_id)
         except Exception:
             pass
     
-    setup_messages[user_id] = []
-    
     # Показываем итоговые настройки
     show_final_settings(call.message.chat.id, user_id)
 
@@ -157,22 +149,59 @@ def end_dialogue(message):
     bot.reply_to(message, "Диалог завершен. Бот остановлен.")
     bot.stop_polling()
 
-@bot.message_handler(func=lambda message: True)
-def handle_message(message):
-    user_id = message.from_user.id
-    if user_id not in user_settings:
-        bot.reply_to(message, "Пожалуйста, начните диалог с команды /start")
-        return
+def edit_reply(reply, text, strict=True):
+    """
+    Заменяет текст отправленного ботом сообщения.
+
+    Args:
+        reply: Сообщение бота
+        text (str): Новый текст
+        strict (bool): Пробрасывать ошибки телеграма (кроме ошибки "текст не изменился")
+    """
+    try:
+        bot.edit_message_text(text, reply.chat.id, reply.message_id)
+    except telebot.apihelper.ApiTelegramException as e:
+        if strict and "message is not modified" not in str(e):
+            raise
+    except Exception:
+        if strict:
+            raise
 
+def answer_question(message, settings):
+    """
+    Готовит ответ на вопрос пользователя и отправляет его. Выполняется в пуле dispatcher.
+    В потоковом режиме ответ сразу отправляется заготовкой, которая редактируется по мере генерации.
+
+    Args:
+        message: Сообщение пользователя с вопросом
+        settings (dict): Снимок настроек пользователя на момент получения вопроса
+    """
+    reply = None
+    stream = None
     try:
         user_message = message.text
-        qa_chain = user_settings[user_id]['qa_chain']
-        num_attempts = user_settings[user_id]['num_attempts']
+        num_attempts = settings['num_attempts']
+
+        if STREAMING:
+            reply = bot.reply_to(message, "⏳ Готовлю ответ...")
+
+            def render(text, final):
+                # окончательный ответ (вместе с источниками) передается в stream.close
+                if final:
+                    edit_reply(reply, text)
+                else:
+                    edit_reply(reply, f"Ответ: {text} ▌", strict=False)
+
+            stream = AnswerStream(render, STREAM_INTERVAL)
         
-        responses = get_multiple_responses(user_message, qa_chain, num_attempts)
+        # если нужен только лучший ответ, попытки прекращаются после первого достаточно уверенного
+        responses = get_multiple_responses(
+            user_message, get_rag_engine(), num_attempts,
+            adaptive=not settings['all_answers'], stream=stream
+        )
         best_answer, best_sources = select_best_response(responses)
 
-        if user_settings[user_id]['all_answers']:
+        if settings['all_answers']:
             response = "=== Все варианты ответов ===\n\n"
             for i, resp in enumerate(responses, 1):
                 response += f"--- Вариант {i} ---\n"
@@ -183,14 +212,56 @@ def handle_message(message):
         else:
             response = f"Ответ: {best_answer}\n"
 
-        if user_settings[user_id]['show_sources']:
+        if settings['show_sources']:
             response += "\nИсточники:\n"
             for s in best_sources:
-                response += f"- ...{s.page_content[:user_settings[user_id]['source_length']]}...\n"
+                response += f"- ...{s.page_content[:settings['source_length']]}...\n"
 
-        bot.reply_to(message, response)
+        # после close попытки, еще работающие в адаптивном режиме, не перезапишут ответ
+        if stream is not None:
+            stream.close(response)
+        elif reply is not None:
+            edit_reply(reply, response)
+        else:
+            bot.reply_to(message, response)
     except Exception as e:
-        bot.reply_to(message, f"Произошла ошибка: {str(e)}")
+        if stream is not None:
+            stream.close(f"Произошла ошибка: {str(e)}")
+        elif reply is not None:
+            edit_reply(reply, f"Произошла ошибка: {str(e)}")
+        else:
+            bot.reply_to(message, f"Произошла ошибка: {str(e)}")
+
+def timed_answer_question(message, settings, received):
+    """
+    Отвечает на вопрос, замеряя время ожидания в очереди и время подготовки ответа.
+    """
+    record("bot.queue_wait", time.time() - received, unit="s")
+    with span("bot.answer", num_attempts=settings['num_attempts']):
+        answer_question(message, settings)
+
+@bot.message_handler(func=lambda message: True)
+def handle_message(message):
+    user_id = message.from_user.id
+    settings = sessions.get(user_id)
+    if settings is None:
+        bot.reply_to(message, "Пожалуйста, начните диалог с команды /start")
+        return
+    if 'all_answers' not in settings:
+        bot.reply_to(message, "Пожалуйста, завершите настройку бота")
+        return
+
+    try:
+        position = dispatcher.submit(user_id, timed_answer_question, message, settings, time.time())
+    except QueueFull:
+        bot.reply_to(message, "⏳ У вас уже слишком много вопросов в очереди. Дождитесь ответа на предыдущие.")
+        return
+
+    if position:
+        bot.reply_to(message, f"⏳ Система занята, ваш вопрос в очереди: #{position}")
 
 if __name__ == "__main__":
-    bot.polling()
\ No newline at end of file
+    # движок создается в фоне, чтобы первый /start не ждал загрузки моделей целиком
+    threading.Thread(target=get_rag_engine, daemon=True).start()
+    bot.polling()
+    dispatcher.shutdown()
@@ -1,15 +1,325 @@
-﻿from config import api_key
-from langchain_mistralai import ChatMistralAI
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import TextLoader
-from langchain_community.retrievers import TFIDFRetriever
-from langchain.retrievers import EnsembleRetriever
+﻿# тяжелые модули (langchain, langchain_community, sklearn, scipy, faiss) импортируются
+# внутри функций при первом обращении, чтобы импорт utils не замедлял запуск
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from chunk_store import ChunkStore, ChunkDocstore
+from metrics import span
 
+from collections import defaultdict
+from typing import Any
+from itertools import islice
 from tqdm import tqdm
+import numpy as np
+import threading
+import hashlib
+import json
+import re
 import time
 import os
-import gc
+
+
+def estimate_tokens(text):
+    """
+    Приближенно оценивает число токенов текста для LLM
+    (для русского текста токенизатор Mistral дает около одного токена на 3 символа).
+
+    Args:
+        text (str): Текст
+
+    Returns:
+        int: Оценка числа токенов
+    """
+    return (len(text) + 2) // 3
+
+
+def reciprocal_rank_fusion(doc_lists, weights=None, c=60, key=None):
+    """
+    Объединяет несколько ранжированных выдач взвешенным reciprocal rank fusion:
+    документ получает сумму weight / (rank + c) по всем выдачам, в которых он встречается.
+
+    Args:
+        doc_lists (list): Ранжированные списки документов
+        weights (list): Веса выдач (по умолчанию все равны 1)
+        c (int): Сглаживающая константа
+        key: Функция, возвращающая идентичность документа (по умолчанию -- chunk_id)
+
+    Returns:
+        list: Документы без повторов, отсортированные по убыванию оценки
+    """
+    if weights is None:
+        weights = [1.0] * len(doc_lists)
+    if key is None:
+        key = lambda doc: doc.metadata['chunk_id']
+
+    rrf_score = defaultdict(float)
+    unique_docs = {}
+
+    for doc_list, weight in zip(doc_lists, weights):
+        for rank, doc in enumerate(doc_list, start=1):
+            doc_key = key(doc)
+            rrf_score[doc_key] += weight / (rank + c)
+            unique_docs.setdefault(doc_key, doc)
+
+    return [unique_docs[k] for k in sorted(unique_docs, key=lambda k: rrf_score[k], reverse=True)]
+
+
+def chunk_hash(text):
+    """
+    Вычисляет хеш содержимого чанка.
+
+    Args:
+        text (str): Текст чанка
+
+    Returns:
+        str: Шестнадцатеричный хеш текста
+    """
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def iter_text_blocks(data_path, block_size=1 << 16):
+    """
+    Читает текстовый файл построчно и выдает блоки примерно по block_size символов.
+    Блок всегда заканчивается пустой строкой, то есть на границе абзаца,
+    поэтому разбиение блоков на чанки почти не отличается от разбиения всего файла.
+
+    Args:
+        data_path (str): Путь к текстовому файлу
+        block_size (int): Минимальный размер блока в символах
+
+    Yields:
+        tuple: (позиция начала блока в файле в символах, текст блока)
+    """
+    buffer = []
+    size = 0
+    start = 0
+
+    with open(data_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            buffer.append(line)
+            size += len(line)
+            if size >= block_size and not line.strip():
+                yield start, ''.join(buffer)
+                start += size
+                buffer, size = [], 0
+
+    if buffer:
+        yield start, ''.join(buffer)
+
+
+def split_with_offsets(text_splitter, text, chunk_overlap):
+    """
+    Разделяет текст на чанки и находит позицию каждого чанка в тексте
+    так же, как это делает splitter с add_start_index=True.
+
+    Yields:
+        tuple: (позиция чанка в тексте, текст чанка)
+    """
+    index, previous_len = 0, 0
+    for chunk in text_splitter.split_text(text):
+        index = text.find(chunk, max(0, index + previous_len - chunk_overlap))
+        previous_len = len(chunk)
+        yield index, chunk
+
+
+def iter_chunks(data_path="data/all_content.txt", chunk_size=500, chunk_overlap=50):
+    """
+    Лениво разделяет текстовый файл на чанки, не загружая его в память целиком.
+    Каждому чанку присваивается идентификатор на основе хеша содержимого;
+    одинаковые по содержимому чанки различаются порядковым номером вхождения.
+
+    Args:
+        data_path (str): Путь к текстовому файлу
+        chunk_size (int): Размер каждого чанка текста
+        chunk_overlap (int): Размер перекрытия между чанками
+
+    Yields:
+        Document: Очередной чанк с metadata['source'], metadata['chunk_id']
+            и metadata['start_index'] (позиция начала чанка в файле)
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    occurrences = defaultdict(int)
+
+    for block_start, block in iter_text_blocks(data_path):
+        for index, text in split_with_offsets(text_splitter, block, chunk_overlap):
+            digest = chunk_hash(text)
+            chunk_id = f"{digest}-{occurrences[digest]}"
+            occurrences[digest] += 1
+            yield Document(page_content=text, metadata={
+                'source': data_path,
+                'chunk_id': chunk_id,
+                'start_index': block_start + index,
+            })
+
+
+# число серий в каждом сезоне
+SEASON_EPISODES = (10, 10, 10, 10, 10, 10, 7, 6)
+
+EPISODE_HEADER = re.compile(r'Серия (\d+)')
+
+# заголовок биографии -- короткая строка (имя персонажа) после двух и более пустых строк
+HERO_HEADER_MAX_LENGTH = 60
+
+
+def episode_season(episode):
+    """
+    Returns:
+        int: Номер сезона серии по ее сквозному номеру или None
+    """
+    for season, count in enumerate(SEASON_EPISODES, 1):
+        if episode <= count:
+            return season
+        episode -= count
+    return None
+
+
+def parse_corpus_documents(data_path):
+    """
+    Восстанавливает документы корпуса по его разметке: серия начинается
+    с заголовка "Серия N", биография -- с имени персонажа на отдельной
+    короткой строке после двух и более пустых строк.
+
+    Args:
+        data_path (str): Путь к файлу корпуса
+
+    Returns:
+        list: Документы корпуса по порядку (в формате read_corpus_documents);
+            текст до первого заголовка -- документ без метаданных
+    """
+    documents = []
+    lines, start, metadata = [], 0, None
+
+    def close():
+        text = ''.join(lines).rstrip()
+        if text:
+            documents.append({'digest': chunk_hash(text), 'start': start, 'length': len(text), 'metadata': metadata})
+
+    position, blank = 0, 0
+    with open(data_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            stripped = line.strip()
+            match = EPISODE_HEADER.fullmatch(stripped)
+            header = None
+            if match:
+                episode = int(match.group(1))
+                header = {'kind': 'episode', 'season': episode_season(episode), 'episode': episode}
+            elif stripped and blank >= 2 and len(stripped) <= HERO_HEADER_MAX_LENGTH:
+                header = {'kind': 'hero', 'hero': stripped}
+
+            if header is not None or (metadata is None and not lines and stripped):
+                close()
+                lines, start, metadata = [], position, header or {}
+            if lines or stripped:
+                lines.append(line)
+
+            blank = 0 if stripped else blank + 1
+            position += len(line)
+
+    close()
+    return documents
+
+
+def corpus_documents_path(data_path):
+    """
+    Returns:
+        str: Путь к описанию документов корпуса, которое записывает data/corpus_builder.py
+            (all_content.txt -> all_content.json)
+    """
+    return os.path.splitext(data_path)[0] + ".json"
+
+
+def read_corpus_documents(data_path, digest):
+    """
+    Читает описание документов корпуса (серий и биографий): их позиции в файле,
+    хеши и метаданные.
+
+    Args:
+        data_path (str): Путь к файлу корпуса
+        digest (str): SHA-1 файла корпуса
+
+    Returns:
+        list: Документы корпуса по порядку или None, если описания нет
+            или оно составлено для другой версии файла
+    """
+    try:
+        with open(corpus_documents_path(data_path), 'r', encoding='utf-8') as f:
+            corpus = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if corpus.get('digest') != digest:
+        return None
+    for document in corpus['documents']:
+        metadata = document['metadata']
+        if metadata.get('kind') == 'episode':
+            metadata.setdefault('season', episode_season(metadata['episode']))
+    return corpus['documents']
+
+
+def iter_document_chunks(data_path, documents, chunk_size=500, chunk_overlap=50, previous=None):
+    """
+    Разделяет корпус на чанки по документам: чанк не пересекает границу
+    серии или биографии, поэтому правка одного документа меняет только его чанки.
+    Чанки документов, не изменившихся с прошлого разбиения, берутся
+    из прошлого хранилища без повторного разбиения.
+
+    Args:
+        data_path (str): Путь к файлу корпуса
+        documents (list): Документы корпуса (см. read_corpus_documents)
+        chunk_size (int): Размер каждого чанка текста
+        chunk_overlap (int): Размер перекрытия между чанками
+        previous (ChunkStore): Прошлое хранилище с теми же параметрами разбиения;
+            закрывается, когда из него взяты все чанки
+
+    Yields:
+        Document: Очередной чанк с metadata['source'], metadata['chunk_id'],
+            metadata['start_index'] и metadata['document'] (номер документа)
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    occurrences = defaultdict(int)
+    reusable = {}
+    if previous is not None:
+        reusable = {document['digest']: n for n, document in enumerate(previous.documents)}
+    reused = 0
+
+    try:
+        with open(data_path, 'r', encoding='utf-8') as f:
+            position = 0
+            for n, document in enumerate(documents):
+                # файл читается подряд: разделители между документами пропускаются
+                f.read(document['start'] - position)
+                text = f.read(document['length'])
+                position = document['start'] + document['length']
+
+                old = reusable.get(document['digest'])
+                if old is not None:
+                    reused += 1
+                    old_start = previous.documents[old]['start']
+                    pieces = [(int(previous.starts[i]) - old_start, previous.text(i))
+                              for i in previous.document_chunks(old)]
+                else:
+                    pieces = split_with_offsets(text_splitter, text, chunk_overlap)
+
+                for index, chunk in pieces:
+                    digest = chunk_hash(chunk)
+                    chunk_id = f"{digest}-{occurrences[digest]}"
+                    occurrences[digest] += 1
+                    yield Document(page_content=chunk, metadata={
+                        'source': data_path,
+                        'chunk_id': chunk_id,
+                        'start_index': document['start'] + index,
+                        'document': n,
+                    })
+    finally:
+        if previous is not None:
+            previous.close()
+
+    if previous is not None:
+        print(f"Разбиение корпуса: {reused} документов без изменений, "
+              f"{len(documents) - reused} разбито заново")
 
 
 def load_and_split_text(data_path="data/all_content.txt", chunk_size=500, chunk_overlap=50):
@@ -22,110 +332,1095 @@ def load_and_split_text(data_path="data/all_content.txt", chunk_size=500, chunk_
         chunk_overlap (int): Размер перекрытия между чанками
     
     Returns:
-        list: Список документов, разделенных на чанки
+        list: Список документов, разделенных на чанки (с metadata['chunk_id'])
     """
 
-    loader = TextLoader(data_path)
-    documents = loader.load()
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    texts = text_splitter.split_documents(documents)
+    return list(iter_chunks(data_path, chunk_size, chunk_overlap))
+
+
+def file_digest(path, block_size=1 << 20):
+    """
+    Returns:
+        str: SHA-1 содержимого файла
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_or_build_store(data_path="data/all_content.txt", chunk_size=500, chunk_overlap=50,
+                        store_path="faiss_index/chunks"):
+    """
+    Открывает компактное хранилище чанков, если оно построено по тому же файлу
+    с теми же параметрами разбиения; иначе разбивает файл заново и записывает
+    чанки в хранилище потоком, не держа их в памяти.
+
+    Корпус разбивается по документам (сериям и биографиям) с их метаданными:
+    по описанию, записанному рядом с корпусом (см. data/corpus_builder.py),
+    а если его нет -- по заголовкам в тексте (см. parse_corpus_documents).
+    Чанки неизменившихся документов переносятся из прошлого хранилища.
+
+    Args:
+        data_path (str): Путь к текстовому файлу
+        chunk_size (int): Размер каждого чанка текста
+        chunk_overlap (int): Размер перекрытия между чанками
+        store_path (str): Папка хранилища чанков
+
+    Returns:
+        ChunkStore: Хранилище чанков (Document создаются при обращении)
+    """
+    key = {
+        'source': data_path,
+        'digest': file_digest(data_path),
+        'chunk_size': chunk_size,
+        'chunk_overlap': chunk_overlap,
+    }
+
+    store = ChunkStore.open(store_path, key)
+    if store is not None:
+        return store
+
+    documents = read_corpus_documents(data_path, key['digest'])
+    if documents is None:
+        documents = parse_corpus_documents(data_path)
+    if not documents:
+        return ChunkStore.build(store_path, iter_chunks(data_path, chunk_size, chunk_overlap), key)
+
+    # чанки прошлого хранилища можно переносить, только если оно разбито по документам с теми же параметрами
+    previous = ChunkStore.open(store_path)
+    if previous is not None:
+        previous_key = previous.meta.get('key') or {}
+        if not previous.documents or previous_key.get('chunk_size') != chunk_size \
+                or previous_key.get('chunk_overlap') != chunk_overlap:
+            previous.close()
+            previous = None
+
+    chunks = iter_document_chunks(data_path, documents, chunk_size, chunk_overlap, previous)
+    return ChunkStore.build(store_path, chunks, key, documents)
+
+
+def iter_embedded_batches(docs, embeddings, min_batch_size=32, max_batch_size=512):
+    """
+    Вычисляет эмбеддинги потока документов адаптивными батчами.
+    Размер батча удваивается, пока растет пропускная способность модели,
+    и уменьшается вдвое при ее заметном падении.
+
+    Args:
+        docs (iterable): Поток документов
+        embeddings: Модель для создания эмбеддингов
+        min_batch_size (int): Минимальный размер батча
+        max_batch_size (int): Максимальный размер батча
+
+    Yields:
+        tuple: (список документов батча, матрица эмбеддингов float32)
+    """
+    docs = iter(docs)
+    batch_size = min_batch_size
+    best_rate = 0.0
+
+    while True:
+        batch = list(islice(docs, batch_size))
+        if not batch:
+            return
+
+        start_time = time.perf_counter()
+        vectors = np.asarray(embeddings.embed_documents([doc.page_content for doc in batch]), dtype=np.float32)
+        rate = len(batch) / max(time.perf_counter() - start_time, 1e-9)
+
+        yield batch, vectors
+
+        if len(batch) < batch_size:
+            return
+        if rate > best_rate * 1.05:
+            best_rate = rate
+            batch_size = min(batch_size * 2, max_batch_size)
+        elif rate < best_rate * 0.8:
+            batch_size = max(batch_size // 2, min_batch_size)
+
+
+DEFAULT_INDEX_CONFIG = {
+    'index_type': "flat",  # flat, ivf_flat, hnsw, ivf_pq
+    'nlist': 64,           # число кластеров IVF
+    'pq_m': 64,            # число подвекторов PQ (должно делить размерность эмбеддингов)
+    'hnsw_m': 32,          # число связей вершины графа HNSW
+}
+
+# меньше чанков не хватает для обучения кодовых книг PQ (256 центроидов по 39 векторов)
+PQ_MIN_CHUNKS = 256 * 39
+
+
+def import_faiss():
+    """
+    Импортирует faiss при первом обращении.
+
+    Returns:
+        module: Модуль faiss
+    """
+    from langchain_community.vectorstores.faiss import dependable_faiss_import
+
+    return dependable_faiss_import()
+
+
+def faiss_factory_string(index_type, nlist, pq_m, hnsw_m):
+    """
+    Формирует строку для faiss.index_factory по типу индекса.
+
+    Args:
+        index_type (str): Тип индекса: flat, ivf_flat, hnsw или ivf_pq
+        nlist (int): Число кластеров IVF
+        pq_m (int): Число подвекторов PQ
+        hnsw_m (int): Число связей вершины графа HNSW
+
+    Returns:
+        str: Описание индекса для faiss.index_factory
+    """
+    factory = {
+        "flat": "Flat",
+        "ivf_flat": f"IVF{nlist},Flat",
+        "hnsw": f"HNSW{hnsw_m}",
+        "ivf_pq": f"IVF{nlist},PQ{pq_m}",
+    }
+    if index_type not in factory:
+        raise ValueError(f"Неизвестный тип индекса: {index_type}. Доступны: {', '.join(factory)}")
+
+    return factory[index_type]
+
+
+def train_sample_size(index_config):
+    """
+    Определяет, сколько векторов нужно накопить для обучения индекса
+    (около 39 векторов на кластер IVF и не меньше 256 на кодовую книгу PQ).
+
+    Args:
+        index_config (dict): Параметры индекса (см. DEFAULT_INDEX_CONFIG)
+
+    Returns:
+        int: Размер обучающей выборки (0 -- индекс не требует обучения)
+    """
+    index_type = index_config['index_type']
+    if index_type == "ivf_flat":
+        return index_config['nlist'] * 39
+    if index_type == "ivf_pq":
+        return max(index_config['nlist'], 256) * 39
+    return 0
+
+
+def fit_index_config(index_config, n_chunks):
+    """
+    Подгоняет параметры индекса под размер корпуса: число кластеров IVF
+    ограничивается так, чтобы на кластер приходилось не меньше 39 векторов,
+    а IVF-PQ на корпусе меньше PQ_MIN_CHUNKS чанков заменяется на IVF-Flat
+    (обучение кодовых книг PQ на такой выборке занимает минуты и дает плохое качество).
+
+    Args:
+        index_config (dict): Параметры индекса (см. DEFAULT_INDEX_CONFIG)
+        n_chunks (int): Число чанков в корпусе
+
+    Returns:
+        dict: Параметры, с которыми строится индекс
+    """
+    index_config = dict(index_config)
+    if index_config['index_type'] == "ivf_pq" and n_chunks < PQ_MIN_CHUNKS:
+        print(f"Для ivf_pq нужно не меньше {PQ_MIN_CHUNKS} чанков, получено {n_chunks}: строится ivf_flat")
+        index_config['index_type'] = "ivf_flat"
+    if index_config['index_type'] in ("ivf_flat", "ivf_pq"):
+        index_config['nlist'] = max(1, min(index_config['nlist'], n_chunks // 39))
+    return index_config
+
+
+def create_faiss_index(sample, index_config):
+    """
+    Создает и при необходимости обучает индекс FAISS на выборке векторов.
+    Если выборка меньше требуемой, число кластеров IVF уменьшается.
+
+    Args:
+        sample (np.ndarray): Обучающая выборка векторов float32
+        index_config (dict): Параметры индекса (см. DEFAULT_INDEX_CONFIG)
+
+    Returns:
+        faiss.Index: Готовый к добавлению векторов индекс
+    """
+    faiss = import_faiss()
+    index_type = index_config['index_type']
+    nlist = min(index_config['nlist'], max(1, len(sample) // 39))
+
+    if index_type == "ivf_pq" and len(sample) < 256:
+        raise ValueError(f"Для индекса ivf_pq нужно не меньше 256 чанков, получено {len(sample)}")
+
+    factory = faiss_factory_string(index_type, nlist, index_config['pq_m'], index_config['hnsw_m'])
+    index = faiss.index_factory(sample.shape[1], factory)
+    if not index.is_trained:
+        index.train(sample)
+
+    return index
+
+
+def configure_search(index, nprobe=None, ef_search=None):
+    """
+    Настраивает параметры поиска индекса FAISS (можно менять в любой момент).
+
+    Args:
+        index (faiss.Index): Индекс FAISS
+        nprobe (int): Число просматриваемых кластеров IVF
+        ef_search (int): Размер списка кандидатов при поиске по графу HNSW
+    """
+    faiss = import_faiss()
+
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and nprobe is not None:
+        ivf.nprobe = nprobe
+    if hasattr(index, 'hnsw') and ef_search is not None:
+        index.hnsw.efSearch = ef_search
+
+
+def filtered_search_params(index, rows, k):
+    """
+    Параметры поиска FAISS только среди заданных строк индекса.
+
+    Векторы вне выборки отсекаются селектором без вычисления расстояний.
+    IVF просматривает все кластеры, так как выбранные векторы могут лежать в любом из них;
+    HNSW расширяет список кандидатов пропорционально тому, насколько выборка меньше индекса.
+
+    Args:
+        index (faiss.Index): Индекс FAISS
+        rows (np.ndarray): Номера строк индекса, среди которых ведется поиск
+        k (int): Число искомых соседей
+
+    Returns:
+        faiss.SearchParameters: Параметры для index.search
+    """
+    faiss = import_faiss()
+    selector = faiss.IDSelectorBatch(np.ascontiguousarray(rows, dtype=np.int64))
+
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nlist)
+    if hasattr(index, 'hnsw'):
+        ef_search = max(index.hnsw.efSearch, min(index.ntotal, k * index.ntotal // max(1, len(rows))))
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search)
+    return faiss.SearchParameters(sel=selector)
+
+
+def index_memory_bytes(index):
+    """
+    Оценивает объем памяти, занимаемой индексом FAISS, по размеру его сериализации.
+
+    Args:
+        index (faiss.Index): Индекс FAISS
+
+    Returns:
+        int: Размер индекса в байтах
+    """
+    faiss = import_faiss()
+    return int(faiss.serialize_index(index).size)
+
+
+def build_faiss_index(store, embeddings, index_config=None, min_batch_size=32, max_batch_size=512):
+    """
+    Строит векторное хранилище по хранилищу чанков, добавляя эмбеддинги
+    в индекс FAISS напрямую из numpy-массивов. Пиковая память на вычисление
+    эмбеддингов ограничена размером батча (и обучающей выборки для IVF), а не размером корпуса.
+    Сами документы в индекс не копируются: docstore читает их из хранилища чанков.
+
+    Args:
+        store (ChunkStore): Хранилище чанков
+        embeddings: Модель для создания эмбеддингов
+        index_config (dict): Параметры индекса (см. DEFAULT_INDEX_CONFIG)
+        min_batch_size (int): Минимальный размер батча
+        max_batch_size (int): Максимальный размер батча
 
-    return texts
+    Returns:
+        tuple: (векторное хранилище FAISS, статистика индексации)
+    """
+    index_config = fit_index_config({**DEFAULT_INDEX_CONFIG, **(index_config or {})}, len(store))
+    train_size = train_sample_size(index_config)
+    factory = faiss_factory_string(
+        index_config['index_type'], index_config['nlist'], index_config['pq_m'], index_config['hnsw_m']
+    )
+    print(f"Индекс FAISS: {factory}" + (f", обучающая выборка {train_size} векторов" if train_size else ""))
+
+    index = None
+    pending = []
+    index_to_docstore_id = {}
+
+    def add_batch(batch, vectors):
+        index.add(vectors)
+        for doc in batch:
+            index_to_docstore_id[len(index_to_docstore_id)] = doc.metadata['chunk_id']
+
+    start_time = time.perf_counter()
+    with tqdm(desc="Индексация чанков", unit=" чанков") as progress:
+        for batch, vectors in iter_embedded_batches(store, embeddings, min_batch_size, max_batch_size):
+            progress.update(len(batch))
+            if index is not None:
+                add_batch(batch, vectors)
+                continue
+
+            # копим выборку, пока ее не хватит для обучения индекса
+            pending.append((batch, vectors))
+            if sum(len(b) for b, _ in pending) >= max(train_size, 1):
+                index = create_faiss_index(np.vstack([v for _, v in pending]), index_config)
+                for b, v in pending:
+                    add_batch(b, v)
+                pending = []
 
+    if index is None and pending:
+        index = create_faiss_index(np.vstack([v for _, v in pending]), index_config)
+        for b, v in pending:
+            add_batch(b, v)
 
-def create_vectorstore(texts, embeddings):
+    if index is None:
+        raise ValueError("Нет документов для индексации")
+
+    elapsed = time.perf_counter() - start_time
+    stats = {
+        'chunks': len(index_to_docstore_id),
+        'seconds': elapsed,
+        'chunks_per_sec': len(index_to_docstore_id) / max(elapsed, 1e-9),
+        'index_type': index_config['index_type'],
+        'memory_bytes': index_memory_bytes(index),
+    }
+
+    from langchain_community.vectorstores import FAISS
+
+    vectorstore = FAISS(embeddings, index, ChunkDocstore(store), index_to_docstore_id)
+    return vectorstore, stats
+
+
+def create_vectorstore(store, embeddings, index_config=None):
     """
-    Создает новое векторное хранилище из текстовых документов.
+    Создает новое векторное хранилище по хранилищу чанков.
+    Идентификаторы документов в хранилище совпадают с их chunk_id.
     
     Args:
-        texts (list): Список документов для индексации
+        store (ChunkStore): Хранилище чанков
         embeddings: Модель для создания эмбеддингов
-        batch_size (int): Размер батча для обработки документов
+        index_config (dict): Параметры индекса (см. DEFAULT_INDEX_CONFIG)
     
     Returns:
         FAISS: Векторное хранилище
     """
 
     print("Создание нового векторного хранилища...")
-    batch_size = 16
-    vectorstore = None
+    vectorstore, stats = build_faiss_index(store, embeddings, index_config)
 
-    for i in tqdm(range(0, len(texts), batch_size), desc="Обработка батчей"):
-        batch = texts[i:i + batch_size]
-        if vectorstore is None:
-            vectorstore = FAISS.from_documents(batch, embeddings)
-        else:
-            vectorstore.add_documents(batch)
-        gc.collect()
-
-    print("Векторное хранилище создано")
+    print(f"Векторное хранилище создано: {stats['chunks']} чанков за {stats['seconds']:.1f} c "
+          f"({stats['chunks_per_sec']:.1f} чанков/с), индекс {stats['index_type']} "
+          f"занимает {stats['memory_bytes'] / 2**20:.1f} МБ")
     return vectorstore
 
 
-def load_or_create_vectorstore(texts, embeddings, new=False):
+def update_vectorstore(vectorstore, store):
+    """
+    Приводит векторное хранилище в соответствие с текущим списком чанков:
+    удаляет пропавшие чанки и вычисляет эмбеддинги только для новых и измененных.
+    Удаление поддерживается только плоским индексом: IVF не перенумеровывает
+    оставшиеся векторы, а HNSW не умеет удалять вовсе.
+
+    Args:
+        vectorstore (FAISS): Загруженное векторное хранилище
+        store (ChunkStore): Актуальное хранилище чанков
+
+    Returns:
+        tuple: (векторное хранилище, число добавленных чанков, число удаленных чанков)
+            или None, если индекс нужно пересоздать целиком
+    """
+    faiss = import_faiss()
+    stored_ids = set(vectorstore.index_to_docstore_id.values())
+    current = store.chunk_ids
+    current_ids = set(current)
+
+    removed = [chunk_id for chunk_id in stored_ids if chunk_id not in current_ids]
+    added = [i for i, chunk_id in enumerate(current) if chunk_id not in stored_ids]
+
+    if removed and not isinstance(vectorstore.index, faiss.IndexFlat):
+        return None
+    if removed:
+        vectorstore.delete(removed)
+
+    # документы уже лежат в хранилище чанков, в индекс добавляются только векторы
+    index_to_docstore_id = vectorstore.index_to_docstore_id
+    for batch, vectors in iter_embedded_batches((store[i] for i in added), vectorstore.embedding_function):
+        vectorstore.index.add(vectors)
+        for doc in batch:
+            index_to_docstore_id[len(index_to_docstore_id)] = doc.metadata['chunk_id']
+
+    return vectorstore, len(added), len(removed)
+
+
+def index_params(model_name, chunk_size, chunk_overlap):
+    """
+    Собирает параметры, от которых зависит содержимое индекса.
+
+    Args:
+        model_name (str): Название модели эмбеддингов
+        chunk_size (int): Размер чанка
+        chunk_overlap (int): Размер перекрытия между чанками
+
+    Returns:
+        dict: Параметры индекса
+    """
+    return {'model_name': model_name, 'chunk_size': chunk_size, 'chunk_overlap': chunk_overlap}
+
+
+def corpus_fingerprint(chunk_ids, params):
+    """
+    Вычисляет отпечаток корпуса: хеш параметров индекса и упорядоченного списка chunk_id.
+
+    Args:
+        chunk_ids (list): chunk_id всех чанков по порядку
+        params (dict): Параметры индекса (см. index_params)
+
+    Returns:
+        str: Отпечаток корпуса
+    """
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8'))
+    for chunk_id in chunk_ids:
+        digest.update(chunk_id.encode('utf-8'))
+    return digest.hexdigest()
+
+
+# версия формата индекса на диске: 2 -- индекс FAISS без pickle, документы в хранилище чанков
+INDEX_FORMAT = 2
+
+
+def save_vectorstore(vectorstore, index_path):
+    """
+    Сохраняет индекс FAISS средствами faiss и соответствие его строк chunk_id в JSON,
+    без pickle docstore (документы лежат в хранилище чанков).
+
+    Args:
+        vectorstore (FAISS): Векторное хранилище
+        index_path (str): Путь к папке индекса
+    """
+    faiss = import_faiss()
+    os.makedirs(index_path, exist_ok=True)
+    faiss.write_index(vectorstore.index, os.path.join(index_path, "index.faiss"))
+
+    # файл docstore старого формата (pickle) больше не используется
+    legacy_path = os.path.join(index_path, "index.pkl")
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+
+    ids = [vectorstore.index_to_docstore_id[i] for i in range(len(vectorstore.index_to_docstore_id))]
+    ids_path = os.path.join(index_path, "index_ids.json")
+    with open(ids_path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(ids, f)
+    os.replace(ids_path + ".tmp", ids_path)
+
+
+def load_vectorstore(index_path, embeddings, store):
+    """
+    Загружает индекс FAISS, сохраненный save_vectorstore.
+
+    Args:
+        index_path (str): Путь к папке индекса
+        embeddings: Модель для создания эмбеддингов запросов
+        store (ChunkStore): Хранилище чанков, из которого читаются документы
+
+    Returns:
+        FAISS: Векторное хранилище
+    """
+    from langchain_community.vectorstores import FAISS
+
+    faiss = import_faiss()
+    index = faiss.read_index(os.path.join(index_path, "index.faiss"))
+    with open(os.path.join(index_path, "index_ids.json"), 'r', encoding='utf-8') as f:
+        ids = json.load(f)
+
+    return FAISS(embeddings, index, ChunkDocstore(store), dict(enumerate(ids)))
+
+
+def read_manifest(index_path):
+    """
+    Читает манифест индекса.
+
+    Args:
+        index_path (str): Путь к папке индекса
+
+    Returns:
+        dict: Манифест или None, если его нет или он поврежден
+    """
+    manifest_path = os.path.join(index_path, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(index_path, chunk_ids, params, index_config):
+    """
+    Атомарно записывает манифест индекса: параметры, хеши чанков и отпечаток корпуса.
+
+    Args:
+        index_path (str): Путь к папке индекса
+        chunk_ids (list): chunk_id проиндексированных чанков
+        params (dict): Параметры корпуса (см. index_params)
+        index_config (dict): Параметры индекса FAISS (см. DEFAULT_INDEX_CONFIG)
+    """
+    manifest = {
+        'format': INDEX_FORMAT,
+        'params': params,
+        'index': index_config,
+        'fingerprint': corpus_fingerprint(chunk_ids, params),
+        'chunks': list(chunk_ids),
+    }
+
+    manifest_path = os.path.join(index_path, "manifest.json")
+    with open(manifest_path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def load_or_create_vectorstore(store, embeddings, index_path="faiss_index", model_name=None,
+                               chunk_size=500, chunk_overlap=50, index_config=None, new=False):
     """
     Загружает существующее векторное хранилище или создает новое.
+
+    Рядом с индексом хранится манифест с параметрами разбиения, названием модели
+    эмбеддингов, типом индекса FAISS и хешами чанков. Если параметры не совпадают
+    (или манифеста нет), индекс пересоздается целиком; иначе пересчитываются эмбеддинги
+    только добавленных и измененных чанков, а удаленные чанки убираются из индекса.
     
     Args:
-        texts (list): Список документов для индексации
+        store (ChunkStore): Хранилище чанков для индексации
         embeddings: Модель для создания эмбеддингов
-        index_path (str): Путь к файлу индекса
-        new (bool): Флаг для создания нового хранилища
+        index_path (str): Путь к папке индекса
+        model_name (str): Название модели эмбеддингов
+        chunk_size (int): Размер чанка, с которым получены чанки
+        chunk_overlap (int): Размер перекрытия, с которым получены чанки
+        index_config (dict): Параметры индекса FAISS (см. DEFAULT_INDEX_CONFIG)
+        new (bool): Флаг для принудительного создания нового хранилища
     
     Returns:
         FAISS: Векторное хранилище
     """
 
-    index_path = "faiss_index"
+    params = index_params(model_name, chunk_size, chunk_overlap)
+    index_config = {**DEFAULT_INDEX_CONFIG, **(index_config or {})}
+    manifest = read_manifest(index_path)
+    index_file = os.path.join(index_path, "index.faiss")
+    chunk_ids = store.chunk_ids
     vectorstore = None
 
-    if os.path.exists(index_path) and new == False:
-        vectorstore = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
+    if new or manifest is None or not os.path.exists(index_file) or manifest.get('format') != INDEX_FORMAT \
+            or manifest.get('params') != params or manifest.get('index') != index_config:
+        if not new and os.path.exists(index_file):
+            print("Индекс не соответствует корпусу или параметрам, пересоздание...")
     else:
-        vectorstore = create_vectorstore(texts, embeddings)
-        vectorstore.save_local(index_path)
+        vectorstore = load_vectorstore(index_path, embeddings, store)
+        if manifest.get('fingerprint') == corpus_fingerprint(chunk_ids, params):
+            return vectorstore
+
+        updated = update_vectorstore(vectorstore, store)
+        if updated is None:
+            print(f"Индекс {index_config['index_type']} не поддерживает удаление, пересоздание...")
+            vectorstore = None
+        else:
+            vectorstore, added, removed = updated
+            print(f"Индекс обновлен: добавлено {added}, удалено {removed} чанков")
+
+    if vectorstore is None:
+        vectorstore = create_vectorstore(store, embeddings, index_config)
+
+    save_vectorstore(vectorstore, index_path)
+    write_manifest(index_path, chunk_ids, params, index_config)
     
     return vectorstore
 
 
-def setup_retrievers(vectorstore, texts):
+class HybridRetriever(BaseRetriever):
+    """
+    Ансамбль FAISS & TF-IDF retrievers с поддержкой пакетного поиска.
+
+    Для списка запросов выполняет один батчевый проход модели эмбеддингов,
+    один поиск по индексу FAISS и одно разреженное матричное произведение TF-IDF,
+    после чего объединяет выдачи взвешенным reciprocal rank fusion
+    (так же, как это делает EnsembleRetriever). Документы создаются
+    из хранилища чанков только для найденных результатов.
+
+    Поиск можно ограничить метаданными документов корпуса (сезон, серия, персонаж):
+    фильтр применяется до поиска -- селектором идентификаторов FAISS
+    и выборкой строк матрицы TF-IDF.
+    """
+
+    vectorstore: Any  # FAISS
+    store: Any  # ChunkStore
+    vectorizer: Any  # TfidfVectorizer
+    tfidf_matrix: Any  # CSR-матрица TF-IDF чанков
+    k: int = 5
+    weights: list = [0.75, 0.25]
+    c: int = 60
+    store_rows: Any = None  # строка индекса FAISS для каждого чанка хранилища (заполняется при первом поиске с фильтром)
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        return self.retrieve_batch([query])[0]
+
+    def faiss_rows(self, positions):
+        """
+        Args:
+            positions (np.ndarray): Номера чанков в хранилище
+
+        Returns:
+            np.ndarray: Номера строк индекса FAISS для этих чанков
+        """
+        if self.store_rows is None:
+            rows = np.full(len(self.store), -1, dtype=np.int64)
+            for row, chunk_id in self.vectorstore.index_to_docstore_id.items():
+                position = self.store.position(chunk_id)
+                if position is not None:
+                    rows[position] = row
+            self.store_rows = rows
+
+        rows = self.store_rows[positions]
+        return rows[rows >= 0]
+
+    def search_faiss(self, queries, positions=None):
+        """
+        Ищет ближайшие чанки для всех запросов одним обращением к индексу FAISS.
+
+        Args:
+            queries (list): Список запросов
+            positions (np.ndarray): Номера чанков, среди которых ведется поиск (None -- все чанки)
+
+        Returns:
+            list: Списки документов для каждого запроса
+        """
+        embeddings = self.vectorstore.embedding_function
+        # CachedEmbeddings берет повторные запросы из кэша, другие модели кодируют запросы как документы
+        embed = getattr(embeddings, 'embed_queries', embeddings.embed_documents)
+        with span("retrieve.embed_queries", queries=len(queries)):
+            vectors = np.asarray(embed(queries), dtype=np.float32)
+        with span("retrieve.faiss", queries=len(queries), filtered=positions is not None):
+            index = self.vectorstore.index
+            if positions is None:
+                _, indices = index.search(vectors, self.k)
+            else:
+                params = filtered_search_params(index, self.faiss_rows(positions), self.k)
+                _, indices = index.search(vectors, self.k, params=params)
+
+        results = []
+        for row in indices:
+            docs = []
+            for i in row:
+                if i == -1:
+                    continue
+                doc = self.store.get(self.vectorstore.index_to_docstore_id[i])
+                if doc is not None:
+                    docs.append(doc)
+            results.append(docs)
+
+        return results
+
+    def search_tfidf(self, queries, positions=None):
+        """
+        Ранжирует чанки по TF-IDF для всех запросов одним матричным произведением.
+        Строки матрицы TF-IDF нормированы, поэтому скалярное произведение
+        совпадает с косинусной близостью.
+
+        Args:
+            queries (list): Список запросов
+            positions (np.ndarray): Номера чанков, среди которых ведется поиск (None -- все чанки)
+
+        Returns:
+            list: Списки документов для каждого запроса
+        """
+        with span("retrieve.tfidf", queries=len(queries), filtered=positions is not None):
+            query_matrix = self.vectorizer.transform(queries)
+            matrix = self.tfidf_matrix if positions is None else self.tfidf_matrix[positions]
+            scores = (matrix @ query_matrix.T).toarray()
+
+        results = []
+        for column in scores.T:
+            top = column.argsort()[-self.k:][::-1]
+            if positions is not None:
+                top = positions[top]
+            results.append([self.store[int(i)] for i in top])
+
+        return results
+
+    def fuse(self, doc_lists):
+        """
+        Объединяет выдачи retrievers взвешенным reciprocal rank fusion.
+
+        Args:
+            doc_lists (list): Выдачи FAISS и TF-IDF для одного запроса
+
+        Returns:
+            list: Документы без повторов, отсортированные по убыванию оценки
+        """
+        return reciprocal_rank_fusion(doc_lists, self.weights, self.c, key=lambda doc: doc.page_content)
+
+    def retrieve_batch(self, queries, metadata_filter=None):
+        """
+        Выполняет поиск сразу для списка запросов (например, перефразировок вопроса).
+
+        Args:
+            queries (list): Список запросов
+            metadata_filter (dict): Ограничение поиска по метаданным документов,
+                например {'season': 3} или {'hero': 'Джон Сноу'} (см. ChunkStore.select)
+
+        Returns:
+            list: Списки найденных документов в порядке запросов
+        """
+        positions = None
+        if metadata_filter:
+            positions = self.store.select(metadata_filter)
+            if not len(positions):
+                return [[] for _ in queries]
+
+        faiss_results = self.search_faiss(queries, positions)
+        tfidf_results = self.search_tfidf(queries, positions)
+
+        with span("retrieve.fuse", queries=len(queries)):
+            return [self.fuse(doc_lists) for doc_lists in zip(faiss_results, tfidf_results)]
+
+
+class PackedContextRetriever(BaseRetriever):
+    """
+    Retriever для stuff-цепочки RetrievalQA: найденные чанки упаковываются
+    в контекст так же, как при генерации через RAGEngine.generate
+    (без почти дубликатов, со склеенными соседними чанками, в пределах бюджета токенов).
+    """
+
+    retriever: Any  # HybridRetriever
+    pack: Any  # функция (документы) -> (документы контекста, оценка числа токенов)
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        docs = self.retriever.retrieve_batch([query])[0]
+        return self.pack(docs)[0]
+
+
+def fit_tfidf(store):
+    """
+    Обучает TF-IDF по текстам хранилища чанков (так же, как TFIDFRetriever.from_texts).
+
+    Args:
+        store (ChunkStore): Хранилище чанков
+
+    Returns:
+        tuple: (обученный TfidfVectorizer, CSR-матрица TF-IDF чанков)
+    """
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    vectorizer = TfidfVectorizer()
+    matrix = vectorizer.fit_transform(store.iter_texts())
+    return vectorizer, matrix
+
+
+def save_tfidf(vectorizer, matrix, tfidf_path, fingerprint):
+    """
+    Сохраняет обученный TF-IDF индекс в компактном виде без pickle:
+    словарь -- в JSON, вектор IDF и CSR-матрица документов -- в виде сырых массивов .npy.
+
+    Args:
+        vectorizer (TfidfVectorizer): Обученный векторизатор
+        matrix: Матрица TF-IDF чанков
+        tfidf_path (str): Путь к папке TF-IDF индекса
+        fingerprint (str): Отпечаток корпуса, по которому построен индекс
+    """
+    from scipy.sparse import csr_matrix
+
+    os.makedirs(tfidf_path, exist_ok=True)
+    matrix = csr_matrix(matrix)
+
+    np.save(os.path.join(tfidf_path, "idf.npy"), vectorizer.idf_.astype(np.float64))
+    np.save(os.path.join(tfidf_path, "data.npy"), matrix.data)
+    np.save(os.path.join(tfidf_path, "indices.npy"), matrix.indices)
+    np.save(os.path.join(tfidf_path, "indptr.npy"), matrix.indptr)
+
+    with open(os.path.join(tfidf_path, "vocabulary.json"), 'w', encoding='utf-8') as f:
+        json.dump({term: int(i) for term, i in vectorizer.vocabulary_.items()}, f, ensure_ascii=False)
+
+    # метаданные пишутся последними: их наличие означает, что индекс сохранен целиком
+    meta = {'fingerprint': fingerprint, 'shape': list(matrix.shape)}
+    with open(os.path.join(tfidf_path, "meta.json"), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+
+def load_tfidf(tfidf_path, fingerprint):
+    """
+    Загружает сохраненный TF-IDF индекс, отображая массивы в память (mmap).
+
+    Args:
+        tfidf_path (str): Путь к папке TF-IDF индекса
+        fingerprint (str): Ожидаемый отпечаток корпуса
+
+    Returns:
+        tuple: (TfidfVectorizer, CSR-матрица) или None, если индекса нет или он построен по другому корпусу
+    """
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from scipy.sparse import csr_matrix
+
+    meta_path = os.path.join(tfidf_path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta.get('fingerprint') != fingerprint:
+        return None
+
+    with open(os.path.join(tfidf_path, "vocabulary.json"), 'r', encoding='utf-8') as f:
+        vocabulary = json.load(f)
+
+    vectorizer = TfidfVectorizer(vocabulary=vocabulary)
+    vectorizer.idf_ = np.load(os.path.join(tfidf_path, "idf.npy"))
+
+    matrix = csr_matrix(
+        (
+            np.load(os.path.join(tfidf_path, "data.npy"), mmap_mode='r'),
+            np.load(os.path.join(tfidf_path, "indices.npy"), mmap_mode='r'),
+            np.load(os.path.join(tfidf_path, "indptr.npy"), mmap_mode='r'),
+        ),
+        shape=tuple(meta['shape']),
+        copy=False
+    )
+
+    return vectorizer, matrix
+
+
+def load_or_create_tfidf(store, index_path, fingerprint):
+    """
+    Загружает TF-IDF индекс, сохраненный рядом с индексом FAISS, или обучает
+    и сохраняет новый, если корпус изменился.
+
+    Args:
+        store (ChunkStore): Хранилище чанков
+        index_path (str): Путь к папке индекса
+        fingerprint (str): Отпечаток корпуса (см. corpus_fingerprint)
+
+    Returns:
+        tuple: (TfidfVectorizer, CSR-матрица TF-IDF чанков)
+    """
+    tfidf_path = os.path.join(index_path, "tfidf")
+
+    loaded = load_tfidf(tfidf_path, fingerprint)
+    if loaded is None:
+        loaded = fit_tfidf(store)
+        save_tfidf(*loaded, tfidf_path, fingerprint)
+
+    return loaded
+
+
+def setup_retrievers(vectorstore, store, index_path=None, fingerprint=None):
     """
     Настраивает и комбинирует FAISS & TF-IDF retrievers.
+    Если указаны index_path и fingerprint, TF-IDF индекс загружается с диска
+    (и обучается только при изменении корпуса).
     
     Args:
         vectorstore (FAISS): Векторное хранилище FAISS
-        texts (list): Список документов для TF-IDF
+        store (ChunkStore): Хранилище чанков
+        index_path (str): Путь к папке индекса
+        fingerprint (str): Отпечаток корпуса
     
     Returns:
-        EnsembleRetriever: Комбинированный retriever
+        HybridRetriever: Комбинированный retriever
     """
 
-    faiss_retriever = vectorstore.as_retriever(
-        search_type="similarity",
-        search_kwargs={'k': 5, 'fetch_k': 15}
-    )
-
-    tfidf_retriever = TFIDFRetriever.from_documents(texts, k=5)
+    if index_path is not None and fingerprint is not None:
+        vectorizer, matrix = load_or_create_tfidf(store, index_path, fingerprint)
+    else:
+        vectorizer, matrix = fit_tfidf(store)
 
-    return EnsembleRetriever(
-        retrievers=[faiss_retriever, tfidf_retriever],
+    return HybridRetriever(
+        vectorstore=vectorstore,
+        store=store,
+        vectorizer=vectorizer,
+        tfidf_matrix=matrix,
+        k=5,
         weights=[0.75, 0.25]
     )
 
 
-def initialize_llm(api_key, model_name="mistral-large-latest"):
+def word_shingles(text, size=3):
     """
-    Инициализирует языковую модель Mistral.
-    
+    Returns:
+        set: Множество последовательностей из size слов текста
+    """
+    words = text.lower().split()
+    return {tuple(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+
+def merge_spans(spans):
+    """
+    Склеивает перекрывающиеся и соседние фрагменты одного источника.
+    Фрагменты без позиции в источнике (start is None) не склеиваются.
+
     Args:
-        api_key (str): API ключ для Mistral
-        model_name (str): название испльзуемой модели
-    
+        spans (list): Фрагменты-словари с ключами source, start, text, rank, chunk_ids
+
+    Returns:
+        list: Склеенные фрагменты
+    """
+    merged = [dict(span) for span in spans if span['start'] is None]
+    positioned = sorted((span for span in spans if span['start'] is not None),
+                        key=lambda x: (x['source'], x['start']))
+
+    last = None
+    for span in positioned:
+        last_end = last['start'] + len(last['text']) if last is not None else None
+
+        # соседние фрагменты разделены не более чем парой пробельных символов
+        if last is not None and last['source'] == span['source'] and span['start'] <= last_end + 2:
+            tail = span['text'][max(0, last_end - span['start']):]
+            if tail:
+                last['text'] += ('' if span['start'] <= last_end else '\n') + tail
+            last['rank'] = min(last['rank'], span['rank'])
+            last['chunk_ids'] = last['chunk_ids'] + span['chunk_ids']
+        else:
+            last = dict(span)
+            merged.append(last)
+
+    return merged
+
+
+def pack_context(docs, token_budget=None, duplicate_threshold=0.9):
+    """
+    Собирает контекст для промпта из ранжированных документов: отбрасывает
+    почти дубликаты, склеивает перекрывающиеся и соседние чанки одного источника
+    и добавляет документы в порядке релевантности, пока не исчерпан бюджет токенов.
+
+    Args:
+        docs (list): Документы, отсортированные по убыванию релевантности
+        token_budget (int): Максимальное число токенов контекста (None -- без ограничения)
+        duplicate_threshold (float): Доля общих триграмм слов, начиная с которой чанк считается дубликатом
+
     Returns:
-        ChatMistralAI: Инициализированная модель
+        tuple: (список документов контекста, оценка числа токенов контекста)
     """
-    return ChatMistralAI(
-        mistral_api_key=api_key,
-        model=model_name,
-        timeout=20
-    )
\ No newline at end of file
+    kept_shingles = []
+    spans = []
+    tokens = 0
+
+    for rank, doc in enumerate(docs):
+        shingles = word_shingles(doc.page_content)
+        if any(len(shingles & other) / len(shingles | other) >= duplicate_threshold for other in kept_shingles):
+            continue
+
+        span = {
+            'source': doc.metadata.get('source'),
+            'start': doc.metadata.get('start_index'),
+            'text': doc.page_content,
+            'rank': rank,
+            'chunk_ids': [doc.metadata.get('chunk_id')],
+        }
+
+        candidate = merge_spans(spans + [span])
+        candidate_tokens = sum(estimate_tokens(x['text']) for x in candidate)
+        if token_budget is not None and candidate_tokens > token_budget:
+            continue
+
+        spans, tokens = candidate, candidate_tokens
+        kept_shingles.append(shingles)
+
+    packed_docs = [
+        Document(page_content=span['text'], metadata={
+            'source': span['source'],
+            'start_index': span['start'],
+            'chunk_ids': span['chunk_ids'],
+        })
+        for span in sorted(spans, key=lambda x: x['rank'])
+    ]
+
+    return packed_docs, tokens
+
+
+class TokenBucket:
+    """
+    Потокобезопасный ограничитель частоты обращений к API (алгоритм token bucket).
+    Позволяет отправить до capacity запросов сразу, после чего пропускает
+    не более rate запросов в секунду.
+    """
+
+    def __init__(self, rate=1.0, capacity=6):
+        """
+        Args:
+            rate (float): Скорость пополнения корзины (запросов в секунду)
+            capacity (int): Максимальное число запросов, отправляемых без ожидания
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Блокирует поток, пока в корзине не появится нужное количество токенов.
+
+        Args:
+            tokens (int): Количество забираемых токенов
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+
+                wait = (tokens - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class BackgroundEmbeddings(Embeddings):
+    """
+    Модель эмбеддингов, загружаемая в фоновом потоке.
+
+    Позволяет создать RAG-движок, не дожидаясь загрузки модели: индексы
+    загружаются с диска без эмбеддингов, а первый запрос, которому нужна
+    модель, ждет окончания ее загрузки и прогрева.
+    """
+
+    def __init__(self, factory):
+        """
+        Args:
+            factory: Функция без аргументов, создающая модель эмбеддингов
+        """
+        self._model = None
+        self._error = None
+        self._ready = threading.Event()
+        threading.Thread(target=self._load, args=(factory,), name="embeddings-warmup", daemon=True).start()
+
+    def _load(self, factory):
+        try:
+            with span("init.embedding_model"):
+                model = factory()
+                # первый вызов модели заметно медленнее последующих
+                model.embed_query("прогрев")
+            self._model = model
+        except Exception as e:
+            self._error = e
+        finally:
+            self._ready.set()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    @property
+    def model(self):
+        """
+        Модель эмбеддингов; при необходимости дожидается окончания загрузки.
+        """
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        return self._model
+
+    def embed_documents(self, texts):
+        return self.model.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.model.embed_query(text)